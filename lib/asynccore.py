@@ -0,0 +1,250 @@
+# Async core module
+# Runs the control core on one asyncio event loop instead of a thread per job. Servo moves, presence
+# processing and sensor reads are tasks on the loop, blocking hardware calls are handed to a small pool of
+# worker threads with a timeout, and the API is served from the same loop.
+
+import asyncio  # Used for the event loop, tasks and the API server
+import concurrent.futures  # Used for the worker thread pools
+import io  # Used for passing request bodies to the Flask app
+import sys  # Used for the WSGI error stream
+import time  # Used for timing servo and presence steps
+import urllib.parse  # Used for decoding request paths
+
+# Setup constants
+HARDWARE_WORKERS = 2  # Threads for blocking hardware calls (sensor reads, servo steps, radio transmits) (int)
+API_WORKERS = 4  # Threads for running API requests through the Flask app (int)
+HARDWARE_TIMEOUT = 10  # Longest to wait for a hardware call (seconds)
+STEP_RETRY_TIME = 1  # Time before trying a failed servo or presence step again (seconds)
+HEADER_TIMEOUT = 30  # Longest to wait for a client to send its request headers (seconds)
+MAX_HEADER_SIZE = 16384  # Largest request headers accepted (bytes)
+MAX_BODY_SIZE = 1048576  # Largest request body accepted (bytes)
+
+
+# Stands in for the threading.Event a blind or the presence monitor waits on between steps, so a task on the loop
+# can wait on it instead. set() can be called from any thread (API requests, rules, the GPIO interrupt).
+class LoopEvent:
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def set(self):
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    def clear(self):
+        self.loop.call_soon_threadsafe(self.event.clear)
+
+    def is_set(self):
+        return self.event.is_set()
+
+    # Wait until set or the timeout passes (None to wait until set), then clear it ready for the next wait
+    async def wait(self, timeout=None):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+
+
+class AsyncCore:
+    def __init__(self, logger, hardware_workers=HARDWARE_WORKERS, api_workers=API_WORKERS):
+        self.logger = logger
+        self.hardware = concurrent.futures.ThreadPoolExecutor(hardware_workers, thread_name_prefix="hardware")
+        self.control = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="control")  # Rule ticks, one at a time
+        self.api = concurrent.futures.ThreadPoolExecutor(api_workers, thread_name_prefix="api")
+        self.tasks = []
+        self.statistics = {"calls": 0, "timeouts": 0, "errors": 0}
+
+    # Run a blocking hardware call in a worker thread, returns default if it fails or takes longer than the timeout.
+    # A timed out call can't be stopped part way through, but the loop stops waiting for it and carries on.
+    async def call(self, function, *args, timeout=HARDWARE_TIMEOUT, default=None, name=None):
+        name = name or getattr(function, "__name__", "call")
+        self.statistics["calls"] += 1
+        future = asyncio.get_running_loop().run_in_executor(self.hardware, function, *args)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.statistics["timeouts"] += 1
+            self.logger.warning(f"Hardware call {name} timed out after {timeout} seconds")
+        except Exception as e:
+            self.statistics["errors"] += 1
+            self.logger.error(f"Hardware call {name} failed: {e}")
+        return default
+
+    # Run blocking control code (the rules, restoring state) in the control thread
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.control, function, *args)
+
+    def start_task(self, coroutine, name):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.append((name, task))
+        return task
+
+    # Repeatedly run a step function (called with the monotonic time, returns seconds until it is next needed or
+    # None to wait until woken), used for the blind servos and the presence monitor in place of their threads
+    # A step that overruns the timeout is waited for before the next one, as steps must never overlap
+    async def service_loop(self, step, wakeup, name, timeout=HARDWARE_TIMEOUT):
+        loop = asyncio.get_running_loop()
+        while True:
+            future = loop.run_in_executor(self.hardware, step, time.monotonic())
+            try:
+                try:
+                    wait = await asyncio.wait_for(asyncio.shield(future), timeout)
+                except asyncio.TimeoutError:
+                    self.statistics["timeouts"] += 1
+                    self.logger.warning(f"{name} step still running after {timeout} seconds")
+                    wait = await future
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.statistics["errors"] += 1
+                self.logger.error(f"{name} step failed: {e}")
+                wait = STEP_RETRY_TIME
+            await wakeup.wait(wait)
+
+    # Cancel every task and wait for them to finish
+    async def stop_tasks(self):
+        for _, task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*(task for _, task in self.tasks), return_exceptions=True)
+        self.tasks = []
+
+    def shutdown(self):
+        self.hardware.shutdown(wait=False)
+        self.control.shutdown(wait=False)
+        self.api.shutdown(wait=False)
+
+    def get_statistics(self):
+        statistics = dict(self.statistics)
+        statistics["tasks"] = [name for name, task in self.tasks if not task.done()]
+        return statistics
+
+    # Serve a WSGI app (the Flask app) over HTTP/1.1 from the loop. Only the app itself runs in the API threads,
+    # so idle and slow connections don't hold a thread. long_poll, if given, is a coroutine function called with
+    # each request's environ before the app runs, so long polls can wait on the loop rather than in an API thread.
+    async def serve_wsgi(self, app, host, port, long_poll=None):
+        async def handle(reader, writer):
+            try:
+                while await self.handle_request(app, reader, writer, host, port, long_poll):
+                    pass
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            except Exception as e:
+                self.logger.error(f"API connection failed: {e}")
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port, limit=MAX_HEADER_SIZE)
+
+    # Read one request, run it through the app and send the response. Returns True to keep the connection open.
+    async def handle_request(self, app, reader, writer, host, port, long_poll=None):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HEADER_TIMEOUT)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            return False  # Client closed the connection between requests
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, protocol = lines[0].split(" ")
+        except ValueError:
+            await self.send_error(writer, "400 Bad Request")
+            return False
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().upper().replace("-", "_")] = value.strip()
+
+        # Chunked request bodies aren't supported, and the connection is closed as the body can't be skipped
+        if "TRANSFER_ENCODING" in headers:
+            await self.send_error(writer, "501 Not Implemented")
+            return False
+        try:
+            length = int(headers.get("CONTENT_LENGTH", 0) or 0)
+        except ValueError:
+            await self.send_error(writer, "400 Bad Request")
+            return False
+        if length > MAX_BODY_SIZE:
+            await self.send_error(writer, "413 Payload Too Large")
+            return False
+        body = await asyncio.wait_for(reader.readexactly(length), HEADER_TIMEOUT) if length else b""
+
+        path, _, query = target.partition("?")
+        peer = writer.get_extra_info("peername")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.parse.unquote(path, "latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": host,
+            "SERVER_PORT": str(port),
+            "SERVER_PROTOCOL": protocol,
+            "REMOTE_ADDR": peer[0] if peer else "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False}
+        for key, value in headers.items():
+            if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[key] = value
+            else:
+                environ["HTTP_" + key] = value
+
+        keep_alive = protocol == "HTTP/1.1" and headers.get("CONNECTION", "").lower() != "close"
+        if long_poll is not None:
+            await long_poll(environ)
+        return await self.send_response(app, environ, writer, keep_alive)
+
+    async def send_response(self, app, environ, writer, keep_alive):
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            started["status"] = status
+            started["headers"] = response_headers
+
+        # Run the app and get the first chunk in an API thread (Flask does all of its work here)
+        def begin():
+            result = app(environ, start_response)
+            iterator = iter(result)
+            return result, iterator, next(iterator, None)
+
+        result, iterator, chunk = await loop.run_in_executor(self.api, begin)
+        try:
+            response_headers = list(started["headers"])
+            names = [name.lower() for name, _ in response_headers]
+            if "content-length" not in names:
+                if environ["REQUEST_METHOD"] == "HEAD" or started["status"][:3] in ("204", "304"):
+                    pass
+                elif environ["SERVER_PROTOCOL"] == "HTTP/1.1":
+                    response_headers.append(("Transfer-Encoding", "chunked"))
+                else:
+                    keep_alive = False  # HTTP/1.0 has no chunked encoding, so the body ends when the connection closes
+            chunked = ("Transfer-Encoding", "chunked") in response_headers
+            response_headers.append(("Connection", "keep-alive" if keep_alive else "close"))
+            head = f"HTTP/1.1 {started['status']}\r\n" + "".join(f"{name}: {value}\r\n"
+                                                               for name, value in response_headers) + "\r\n"
+            writer.write(head.encode("latin-1"))
+
+            # Send the body, fetching each further chunk in an API thread so streamed exports don't block the loop
+            while chunk is not None:
+                if chunk:
+                    writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+                    await writer.drain()
+                chunk = await loop.run_in_executor(self.api, next, iterator, None)
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            if hasattr(result, "close"):
+                await loop.run_in_executor(self.api, result.close)  # Runs the Flask teardown functions
+        return keep_alive
+
+    async def send_error(self, writer, status):
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode("latin-1"))
+        await writer.drain()
@@ -3,51 +3,113 @@
 ### Change Log
 ### Ver 1 11/7/19: Implemented as a module
 ### Ver 2 9/11/19: Added simulation mode for Lexi development. Included hardware specific modules and removed from main program
+### Ver 3: Servos share one PCA9685 through the I2C bus module instead of each opening the bus
+### Ver 4: Partial positions with per blind calibration, ramped moves and power cut off based on distance moved
+### Ver 5: One blind service thread for all the servos instead of a thread per blind, servo objects use __slots__
 
+import json
 import threading
 import time
-from datetime import datetime
-from datetime import timedelta
+
+from lib import i2cbus
 
 ### Raspberry Pi specific modules
-RPi_module_import_fail = False
-try:
-   import board
-except ImportError:
-   RPi_module_import_fail = True
-   
-try:
-   import busio
-except ImportError:
-   RPi_module_import_fail = True
-   
-try:
-   import adafruit_pca9685
-except ImportError:
-   RPi_module_import_fail = True
+RPi_module_import_fail = i2cbus.module_fail
 
 ### Setup Constants ###
 START_STATE = 10
-WAIT_TIME = 15 # Seconds
+WAIT_TIME = 15 # Seconds, full travel time for a blind with no calibration
+OPEN_STATE = 10 # State the blinds take fully open (100%)
+CLOSED_STATE = 20 # State the blinds take fully closed (0%)
+RAMP_TIME = 0.5 # Seconds to ramp the duty cycle over at the start of a move
+RAMP_STEP = 0.05 # Seconds between ramp steps
+SETTLE_TIME = 0.5 # Seconds to keep the servo powered after it should have arrived
+
+# Calibration for a blind: (percent open, duty cycle) points, interpolated between, and how many seconds a full
+# 0 - 100% move takes. The default matches the original state to duty cycle mapping (state * 0xffff / 200).
+DEFAULT_CALIBRATION = {
+    "points": [[0, int((CLOSED_STATE * 0xffff)/200)], [100, int((OPEN_STATE * 0xffff)/200)]],
+    "travel_time": WAIT_TIME}
+
+
+def state_to_percent(state):
+    return (CLOSED_STATE - state) * 100 / (CLOSED_STATE - OPEN_STATE)
+
+
+def percent_to_state(percent):
+    return whole_state(CLOSED_STATE - percent * (CLOSED_STATE - OPEN_STATE) / 100)
+
+
+# Keep whole states as ints, so positions (and the saved state) only become floats for partial positions
+def whole_state(state):
+    return int(state) if state == int(state) else state
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
 
-# Each blind will have it's own object running as a thread. This allows to check for a certain time after being activated and set incative.
+# Load per blind calibrations from a JSON file ({"left": {"points": [[0, 6553], [50, 4900], [100, 3276]], "travel_time": 12}, ...})
+# Blinds missing from the file (or no file at all) use the default calibration
+def load_calibrations(file_name, logger):
+    try:
+        with open(file_name, "r") as file:
+            calibrations = json.load(file)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logger.warning('Blind calibration file %s is invalid, using defaults: %s' %(file_name, e))
+        return {}
+    for blindname in list(calibrations):
+        calibration = calibrations[blindname]
+        points = calibration.get("points", []) if isinstance(calibration, dict) else []
+        if (not isinstance(points, list) or len(points) < 2
+                or not all(isinstance(point, list) and len(point) == 2 and all(is_number(value) for value in point) for point in points)
+                or sorted(point[0] for point in points) != [point[0] for point in points]):
+            logger.warning('Blind calibration for %s needs at least two [percent, duty cycle] points in order of percent, using default' %blindname)
+            del calibrations[blindname]
+            continue
+        travel_time = calibration.get("travel_time", WAIT_TIME)
+        if not is_number(travel_time) or travel_time <= 0:
+            logger.warning('Blind calibration for %s has an invalid travel time %r, using %d seconds' %(blindname, travel_time, WAIT_TIME))
+            calibration["travel_time"] = WAIT_TIME
+    return calibrations
+
+
+# Stands in for a PCA9685 channel in simulation mode
+class simulation_servo():
+    __slots__ = ("duty_cycle",)
+
+    def __init__(self):
+        self.duty_cycle = 0
+
+
+# Each blind has it's own object, stepped by the blind service thread (or a task in the async core). This allows to check for a certain time after being activated and set incative.
 # Reason is that sometimes the sail winch servos won't quite stop and buzz so want to set duty cycle to 0 after certain amount of time
-class blindservo(threading.Thread):
-    def __init__(self, blindname, pcachannel,logger,simulation=False):
-        self.stoprequest = threading.Event()
+# Moves ramp the duty cycle towards the target to reduce buzzing, and power is cut as soon as the move should have finished
+# (travel time in proportion to the distance moved), so a small adjustment takes about a second rather than the full WAIT_TIME
+class blindservo():
+    __slots__ = ("wakeup", "idle", "pcachannel", "blindname", "simulation", "logger", "calibration_points", "travel_time",
+                 "state", "known", "duty_cycle", "bus", "servo", "active", "ramp_from", "move_start", "cutoff")
+
+    def __init__(self, blindname, pcachannel,logger,simulation=False,calibration=None):
+        self.wakeup = threading.Event() # Set to wake whatever is stepping this blind, replaced by the blind service or async core
+        self.idle = threading.Event()
+        self.idle.set()
         self.pcachannel = pcachannel
         self.blindname = blindname
-        self.pcachannel = pcachannel
         self.simulation=simulation
-        self.state = START_STATE
-        self.duty_cycle=3276
         self.logger = logger
+        self.set_calibration(calibration)
+        self.state = START_STATE
+        self.known = False # If the blind is known to be at state, only once it has been restored or finished a move
+        self.duty_cycle=self.percent_to_duty_cycle(state_to_percent(START_STATE))
         ### Setup PCA9685  ###
         # From https://learn.adafruit.com/adafruit-16-channel-pwm-servo-hat-for-raspberry-pi/using-the-python-library
+        # All servos share the one PCA9685 on the shared bus, which is set up the first time it is asked for
+        self.bus = None
         if not simulation: # Code below dependant on RPi hardware specific modules
-            self.i2c = busio.I2C(board.SCL, board.SDA)
-            self.pca = adafruit_pca9685.PCA9685(self.i2c)
-            self.pca.frequency = 50
+            self.bus = i2cbus.get_bus(logger)
 
         # Check if we have modules imported and not running in simulation
         if not simulation and RPi_module_import_fail:
@@ -55,41 +117,121 @@ class blindservo(threading.Thread):
         
         # This is where the servo is actually controlled. If in simulation mode, we create a dummy servo object. If not, we assign our servo to the right PCA channel object
         if simulation:
-            class simulation_servo():
-                duty_cycle = 0
             self.servo = simulation_servo()
         else:        
-            self.servo = self.pca.channels[pcachannel] # Key code here: Assign our servo object to a PCA channel object
-        self.time_set = datetime.now()
+            self.servo = self.bus.channel(pcachannel) # Key code here: Assign our servo object to a PCA channel object
         self.active = False
-        threading.Thread.__init__(self)
+        self.ramp_from = self.duty_cycle # Duty cycle at the start of the current move
+        self.move_start = 0 # Monotonic time the current move started
+        self.cutoff = 0 # Monotonic time to cut power for the current move
         self.logger.debug('Initialised servo object %s with channel %d' %(self.blindname, self.pcachannel))
-    
-    def stop(self):
+
+    def set_calibration(self, calibration):
+        if calibration is None:
+            calibration = DEFAULT_CALIBRATION
+        self.calibration_points = [tuple(point) for point in calibration["points"]]
+        self.travel_time = calibration.get("travel_time", WAIT_TIME)
+
+    # Interpolate the calibration points to find the duty cycle for a position
+    def percent_to_duty_cycle(self, percent):
+        points = self.calibration_points
+        if percent <= points[0][0]:
+            return int(points[0][1])
+        for (low_percent, low_duty), (high_percent, high_duty) in zip(points, points[1:]):
+            if percent <= high_percent:
+                return int(low_duty + (high_duty - low_duty) * (percent - low_percent) / (high_percent - low_percent))
+        return int(points[-1][1])
+
+    def get_percent(self):
+        return state_to_percent(self.state)
+
+    # Stop the servo, cut_power=False leaves cutting the power to the caller (to do every servo in one bus write)
+    def stop(self, cut_power=True):
         self.logger.debug('Stopping the servo object %s with channel %d' %(self.blindname, self.pcachannel))
-        self.servo.duty_cycle = 0
-        self.stoprequest.set()    
+        if cut_power:
+            self.servo.duty_cycle = 0
+        self.active = False
+        self.idle.set()
 
-    def run(self):
-        self.logger.debug('Running the servo object %s with channel %d' %(self.blindname, self.pcachannel))
+    # Carry on with the current move: step the ramp, and once the move should be finished set duty cycle to 0 to stop
+    # the servo completely. Returns how many seconds until this needs running again (None if nothing is moving)
+    def service(self, now):
+        if not self.active:
+            return None
+        if now >= self.cutoff:
+            self.servo.duty_cycle = 0
+            self.active = False
+            self.known = True
+            self.idle.set()
+            self.logger.debug('Setting servo object %s with channel %d to inactive' %(self.blindname, self.pcachannel))
+            return None
+        ramp_time = min(RAMP_TIME, self.cutoff - self.move_start)
+        if now < self.move_start + ramp_time:
+            duty_cycle = int(self.ramp_from + (self.duty_cycle - self.ramp_from) * (now - self.move_start) / ramp_time)
+            self.servo.duty_cycle = duty_cycle
+            return RAMP_STEP
+        if self.servo.duty_cycle != self.duty_cycle:
+            self.servo.duty_cycle = self.duty_cycle
+        return self.cutoff - now
 
-        # Run the thread until stoprequest is set
-        while not self.stoprequest.isSet():
-            #self.logger.debug('%s servo running and my state is %d and my duty_cycle is %d' %(self.blindname,self.state, self.duty_cycle))
-            # If last time state changed was over WANT_TIME seconds ago, set duty cycle to 0 to stop the servo completely
-            if self.active and (datetime.now() > self.time_set + timedelta(seconds=WAIT_TIME)):
-                self.logger.debug('Setting to 0')
-                self.servo.duty_cycle = 0
-                self.active = False
-                self.logger.debug('Setting servo object %s with channel %d to inactive' %(self.blindname, self.pcachannel))
-            # Sleep so not taking too much CPU
-            time.sleep(1)
+    # Wait for the current move to finish, returns False if it didn't in time
+    def wait_until_idle(self, timeout=None):
+        return self.idle.wait(timeout)
+
+    # The state to save, None while the blind is moving or hasn't been driven or restored yet (its position is unknown)
+    def get_known_state(self):
+        if self.known and not self.active:
+            return self.state
+        return None
+
+    # Set the state from a saved snapshot without moving the servo
+    def restore_state(self, state):
+        self.state = whole_state(state)
+        self.known = True
+        self.duty_cycle = self.percent_to_duty_cycle(state_to_percent(state))
+        self.logger.debug('Restored servo object %s with channel %d to state %s' %(self.blindname, self.pcachannel, self.state))
 
     def set_state(self, state):
-        self.state = state
-        self.duty_cycle = int((self.state * 0xffff)/200)
-        self.servo.duty_cycle = self.duty_cycle
+        self.set_position(state_to_percent(state))
+
+    # Move the blind to a percentage open (0 closed - 100 open)
+    def set_position(self, percent):
+        percent = max(0, min(100, percent))
+        distance = abs(percent - self.get_percent())
+        self.ramp_from = self.duty_cycle
+        self.state = percent_to_state(percent)
+        self.duty_cycle = self.percent_to_duty_cycle(percent)
+        self.move_start = time.monotonic()
+        self.cutoff = self.move_start + self.travel_time * distance / 100 + SETTLE_TIME
         self.active = True
-        self.time_set = datetime.now()
-        self.logger.debug('Setting servo object %s with channel %d to state %d with duty cycle %d' %(self.blindname, self.pcachannel, self.state, self.duty_cycle))
+        self.known = False # Until the move finishes, so a crash part way through leaves it unknown
+        self.idle.clear()
+        self.wakeup.set()
+        self.logger.debug('Setting servo object %s with channel %d to %s%% open (state %s) with duty cycle %d for %.1f seconds'
+                          %(self.blindname, self.pcachannel, percent, self.state, self.duty_cycle, self.cutoff - self.move_start))
+
+
+# One thread steps every blind, sleeping until the soonest ramp step or cut off, or until a new move is started
+class BlindService(threading.Thread):
+    def __init__(self, blinds, logger):
+        threading.Thread.__init__(self, name="blinds", daemon=True)
+        self.blinds = list(blinds)
+        self.logger = logger
+        self.stoprequest = threading.Event()
+        self.wakeup = threading.Event()
+        for blind in self.blinds:
+            blind.wakeup = self.wakeup
 
+    def stop(self):
+        self.logger.debug('Stopping the blind service')
+        self.stoprequest.set()
+        self.wakeup.set()
+
+    def run(self):
+        self.logger.debug('Running the blind service for %d blinds' %len(self.blinds))
+
+        # Run the thread until stoprequest is set
+        while not self.stoprequest.is_set():
+            self.wakeup.clear()
+            waits = [wait for wait in (blind.service(time.monotonic()) for blind in self.blinds) if wait is not None]
+            self.wakeup.wait(min(waits) if waits else None)
@@ -0,0 +1,231 @@
+# Configuration module for the Log Cabin Control System
+# Loads the tunable settings from a JSON file, validates them, and reloads them when the file changes
+
+import ctypes  # Used for calling inotify from the C library
+import ctypes.util
+import json  # Used for reading and writing the config file
+import os  # Used for reading inotify events and replacing the config file atomically
+import select  # Used for waiting on inotify events with a timeout
+import struct  # Used for unpacking inotify events
+import threading  # Used for watching the file alongside the rest of the program
+from types import MappingProxyType  # Used for making each config snapshot read-only
+
+# Settings, their types, defaults and allowed range (or choices for strings)
+SCHEMA = {
+    # Heating
+    "desired_temp_upper_bound": (float, 30, 0, 40),  # The upper bound of the desired temperature
+    "desired_temp_lower_bound": (float, 15, 0, 40),  # The lower bound of the desired temperature
+    "desired_temp_increment": (float, 0.5, 0.1, 5),  # How much to increment or decrement the desired temperature by
+    "desired_temp_margin": (float, 0.5, 0.1, 5),  # How much the actual temperature can deviate from the desired temperature
+    "preheat_hours": (int, 2, 0, 24),  # How many hours ahead to look for an expected arrival
+    "preheat_threshold": (float, 0.5, 0, 1),  # The occupancy probability counted as an expected arrival
+    "setback_temp": (float, 3.0, 0, 10),  # How far to turn the desired temperature down while the cabin is empty
+    # Devices
+    "presence_timeout": (int, 30, 1, 1440),  # Minutes presence is held after the last motion (until the model has learned)
+    "presence_timeout_min": (int, 10, 1, 1440),  # The shortest presence timeout, in minutes
+    "presence_timeout_max": (int, 60, 1, 1440),  # The longest presence timeout, in minutes
+    "presence_debounce": (float, 2, 0, 60),  # Seconds motion sensor edges are merged over
+    # Blinds
+    "cloud_cover_threshold": (float, 0.5, 0, 1),  # The threshold of the percentage cloud cover
+    "temperature_threshold": (float, 20, -30, 50),  # The threshold of the maximum temperature of the day
+    "light_level_threshold": (float, 1200000, 0, None),  # The threshold of the light level outside
+    "light_sensor_gain": (str, "low", ["low", "med", "high", "max"]),  # The gain of the light sensor
+    "blinds_morning_start": (int, 7, 0, 23),  # The hour the morning blinds check starts
+    "blinds_morning_end": (int, 8, 1, 24),  # The hour the morning blinds check ends
+    "blinds_evening_start": (int, 17, 0, 23),  # The hour the evening blinds check starts
+    "blinds_evening_end": (int, 22, 1, 24),  # The hour the evening blinds check ends
+    "solar_timing": (bool, True),  # If the blinds checks follow sunrise and sunset instead of the hours above
+    "blinds_morning_offset": (int, 60, -240, 720),  # Minutes after sunrise the morning blinds check starts
+    "blinds_morning_duration": (int, 60, 1, 720),  # How many minutes the morning blinds check runs for
+    "blinds_evening_offset": (int, -60, -720, 240),  # Minutes after sunset the evening blinds check starts
+    "blinds_evening_duration": (int, 300, 1, 720),  # How many minutes the evening blinds check runs for
+    "solar_min_elevation": (float, 30, 0, 90),  # Days the sun stays below this (degrees) skip the morning blinds check
+    "blind_left_facing": (float, 180, 0, 360),  # The direction each blind faces, in degrees clockwise from north
+    "blind_leftdoor_facing": (float, 180, 0, 360),
+    "blind_rightdoor_facing": (float, 180, 0, 360),
+    "blind_right_facing": (float, 180, 0, 360),
+    # Energy
+    "heater_watts": (float, 2000, 0, 10000),  # Power drawn by the heater socket when on, in watts
+    "devices_watts": (float, 100, 0, 10000),  # Power drawn by the devices socket when on, in watts
+    "energy_price": (float, 0, 0, 1000),  # Price of a kWh (in pence, or any currency unit), 0 to leave out costs
+
+    # Miscellaneous
+    "loop_interval": (int, 60, 1, 3600),  # Seconds between runs of the main code loop
+    "event_retention_days": (int, 90, 1, None),  # How many days of raw event log rows to keep
+    "state_max_age": (int, 60, 0, 10080),  # How many minutes old the saved state can be and still be trusted at startup
+    "debug_endpoints": (bool, False),  # If the profiling and tracing API calls are available
+    "trace_threshold": (float, 500, 0, 60000),  # Operations slower than this are recorded by the tracer, in milliseconds
+    "long_poll_timeout": (int, 30, 1, 300),  # The longest a read API call waits for a change, in seconds
+    "watchdog_sensor_timeout": (int, 10, 1, 1440)}  # Minutes without a good sensor reading before the heating is turned off
+
+# Pairs of settings where the first must be below the second (or can be equal to it)
+ORDERED_PAIRS = [
+    ("desired_temp_lower_bound", "desired_temp_upper_bound", False),
+    ("presence_timeout_min", "presence_timeout_max", True),
+    ("blinds_morning_start", "blinds_morning_end", False),
+    ("blinds_evening_start", "blinds_evening_end", False)]
+
+DEFAULTS = {name: setting[1] for name, setting in SCHEMA.items()}
+
+# inotify constants (from <sys/inotify.h>)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")
+
+
+# Check a set of settings, returns a complete validated copy or raises ValueError
+def validate(values):
+    if not isinstance(values, dict):
+        raise ValueError("Config must be a JSON object")
+    validated = dict(DEFAULTS)
+    for name, value in values.items():
+        if name not in SCHEMA:
+            raise ValueError(f"Unknown setting \"{name}\"")
+        setting = SCHEMA[name]
+        if setting[0] is bool:
+            if not isinstance(value, bool):
+                raise ValueError(f"\"{name}\" must be true or false")
+        elif setting[0] is str:
+            if value not in setting[2]:
+                raise ValueError(f"\"{name}\" must be one of {setting[2]}")
+        else:
+            if isinstance(value, bool) or not isinstance(value, (int, float)) \
+                    or (setting[0] is int and not float(value).is_integer()):
+                raise ValueError(f"\"{name}\" must be a number of type {setting[0].__name__}")
+            value = setting[0](value)
+            if (setting[2] is not None and value < setting[2]) or (setting[3] is not None and value > setting[3]):
+                raise ValueError(f"\"{name}\" must be between {setting[2]} and {setting[3]}")
+        validated[name] = value
+    for lower, upper, allow_equal in ORDERED_PAIRS:
+        if validated[lower] > validated[upper] or (validated[lower] == validated[upper] and not allow_equal):
+            raise ValueError(f"\"{lower}\" must be below \"{upper}\"")
+    return validated
+
+
+# The current settings are a read-only snapshot that is swapped in one go, so a reader always sees either
+# all of the old settings or all of the new ones. Take one snapshot (config.current) per piece of work.
+class Config:
+    def __init__(self, file_name, logger):
+        self.file_name = file_name
+        self.logger = logger
+        self.current = MappingProxyType(dict(DEFAULTS))
+        self.listeners = []
+        self.write_lock = threading.Lock()
+
+    # Add a function to be called with the old and new snapshots whenever the settings change
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # Load the file, keeping the current settings if it is missing or invalid
+    def load(self):
+        with self.write_lock:
+            try:
+                with open(self.file_name, "r") as file:
+                    values = validate(json.load(file))
+            except FileNotFoundError:
+                self.logger.info(f"Config file \"{self.file_name}\" not found, using defaults")
+                values = dict(DEFAULTS)
+            except ValueError as e:  # Also catches JSON decode errors
+                self.logger.error(f"Config file \"{self.file_name}\" is invalid, keeping current settings: {e}")
+                return False
+            self.apply(values)
+            return True
+
+    def apply(self, values):
+        old = self.current
+        if dict(old) == values:
+            return
+        self.current = MappingProxyType(values)
+        self.logger.info("Applied new config")
+        for listener in self.listeners:
+            try:
+                listener(old, self.current)
+            except Exception as e:  # Don't let one listener stop the others
+                self.logger.error(f"Config listener failed: {e}")
+
+    # Change some settings and save them to the file, raises ValueError if they aren't valid
+    def update(self, changes):
+        with self.write_lock:
+            values = validate({**self.current, **changes})
+            changed = {name: value for name, value in values.items() if value != DEFAULTS[name]}
+            temp_file_name = self.file_name + ".tmp"
+            with open(temp_file_name, "w") as file:
+                json.dump(changed, file, indent=4, sort_keys=True)
+                file.write("\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_file_name, self.file_name)
+            self.apply(values)
+
+
+# Watches the config file's directory with inotify (so editors that save by renaming are caught too)
+# and reloads the config when the file is written. Nothing is done between changes.
+class ConfigWatcher(threading.Thread):
+    def __init__(self, config, logger):
+        threading.Thread.__init__(self, name="configwatcher", daemon=True)
+        self.config = config
+        self.logger = logger
+        self.stoprequest = threading.Event()
+        self.file_name = os.path.basename(config.file_name).encode()
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            directory = os.path.dirname(os.path.abspath(config.file_name)).encode()
+            if libc.inotify_add_watch(fd, directory, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.fd = fd
+        except (OSError, AttributeError) as e:  # AttributeError if the C library has no inotify (not Linux)
+            self.logger.warning(f"Config file watching unavailable, changes need a restart or the API: {e}")
+
+    def fileno(self):
+        return self.fd
+
+    def stop(self):
+        self.logger.debug("Stopping the config watcher")
+        self.stoprequest.set()
+
+    def run(self):
+        if self.fd is None:
+            return
+        self.logger.debug("Running the config watcher")
+
+        # Run the thread until stoprequest is set, waking up at least once a second to check
+        while not self.stoprequest.is_set():
+            readable, _, _ = select.select([self.fd], [], [], 1)
+            if readable:
+                self.handle_events()
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    # Read all waiting inotify events and reload the config if any were for the config file
+    def handle_events(self):
+        if self.read_events():
+            self.logger.debug("Config file changed, reloading")
+            self.config.load()
+
+    # Read all waiting inotify events without blocking, returns True if any were for the config file
+    # (Used on its own by the async core, which hands the reload to another thread)
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return False
+        changed = False
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            if name == self.file_name:
+                changed = True
+            offset += EVENT_HEADER.size + length
+        return changed
@@ -5,6 +5,9 @@
 
 import time
 
+from lib import health
+from lib import profiling
+
 ### Raspberry Pi specific modules
 RPi_module_import_fail = False
 try:
@@ -68,6 +71,8 @@ def finish():
     return log_message
 
 
+@profiling.tracer.traced("switchEnergenie")
+@health.watchdog.watched("radio")
 def switchEnergenie(socket,state,logger,repeat=1):
     global simulation_mode
     if simulation_mode:
@@ -91,34 +96,56 @@ def switchEnergenie(socket,state,logger,repeat=1):
 
 
 class device():
+    __slots__ = ("socket_number", "logger", "state", "listeners")
+
     def __init__(self,socket_number,logger):
         self.socket_number = socket_number
         self.logger = logger
         self.state = False
+        self.listeners = []
         
     def get_state(self):
         return self.state
 
+    # Listeners are called with the new state whenever it changes (used for energy accounting)
+    def add_listener(self,listener):
+        self.listeners.append(listener)
+
+    def set_state(self,state):
+        self.state = state
+        for listener in self.listeners:
+            listener(state)
+
+    # Set the state from a saved snapshot without transmitting anything
+    def restore_state(self,state):
+        self.set_state(state)
+
     def switch(self,state):
         if state == ON:
             switchEnergenie(self.socket_number, SKT_ON,self.logger,REPEAT_ENERGENIE)
-            self.state = True
+            self.set_state(True)
         else:
             switchEnergenie(self.socket_number, SKT_OFF,self.logger,REPEAT_ENERGENIE)
-            self.state = False
+            self.set_state(False)
 
 
 class GPIOInputDevice:
-    def __init__(self, pin_number):
+    __slots__ = ("pin_number", "simulation", "state")
+
+    def __init__(self, pin_number, simulation=False):
         self.pin_number = pin_number
+        self.simulation = simulation
         self.state = False
         # Setup the Cabin PIR Pin
-        GPIO.setup(self.pin_number, GPIO.IN)
+        if not simulation:
+            GPIO.setup(self.pin_number, GPIO.IN)
 
     def set_interrupt(self, presence_callback):
         # Setup Interrupt for Cabin PIR Sensor
-        GPIO.add_event_detect(self.pin_number, GPIO.RISING, presence_callback)
+        if not self.simulation:
+            GPIO.add_event_detect(self.pin_number, GPIO.RISING, presence_callback)
 
     def get_state(self):
-        self.state = GPIO.input(self.pin_number)
+        if not self.simulation:
+            self.state = GPIO.input(self.pin_number)
         return self.state
@@ -0,0 +1,158 @@
+# Energy accounting module
+# Adds up how long each Energenie socket is on, and how much energy that uses, as it happens, so daily and monthly
+# totals can be looked up without going back through the event log
+
+import sqlite3  # Used for storing the hourly, daily and monthly totals
+import threading  # Used for sharing the totals between the API and the code switching the sockets
+import time  # Used for timing on periods and working out which hour they fall in
+
+# Setup constants
+FLUSH_INTERVAL = 900  # Time between writing the in-memory totals to the database (seconds)
+PERIODS = [  # Totals kept in the database: table, period column, and how much of the "YYYY-MM-DD HH" hour key it uses
+    ("EnergyHourly", "Hour", 13),
+    ("EnergyDaily", "Day", 10),
+    ("EnergyMonthly", "Month", 7)]
+
+
+def setup_database(db_file):
+    conn = sqlite3.connect(db_file, timeout=30)
+    try:
+        with conn:
+            for table, column, _ in PERIODS:
+                conn.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                    {column} TEXT NOT NULL,
+                    Socket TEXT NOT NULL,
+                    Seconds REAL NOT NULL,
+                    WattHours REAL NOT NULL,
+                    PRIMARY KEY ({column}, Socket))""")
+    finally:
+        conn.close()
+
+
+class Socket:
+    def __init__(self, name, watts):
+        self.name = name
+        self.watts = watts  # Power drawn while on (watts)
+        self.on_since = None  # Time the socket was last switched on or its on time was last counted, None if off
+
+
+# On time is counted into local hours in memory as sockets switch off (or when the totals are asked for), and
+# written to the hourly, daily and monthly tables every flush interval. Energy is worked out with the wattage
+# at the time, so changing the wattage doesn't change the past.
+class EnergyMeter:
+    def __init__(self, db_file, logger, flush_interval=FLUSH_INTERVAL, clock=time.time):
+        self.db_file = db_file  # None to keep only this month's totals, in memory
+        self.logger = logger
+        self.clock = clock  # Returns the current time as seconds since the epoch
+        self.flush_interval = flush_interval
+        self.sockets = {}
+        self.pending = {}  # (hour, socket name) to [seconds, watt hours] not yet written to the database
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self.conn = None  # Kept open between flushes and queries, only used while holding the lock
+
+    def add_socket(self, name, watts):
+        self.sockets[name] = Socket(name, watts)
+
+    def set_watts(self, name, watts):
+        with self.lock:
+            socket = self.sockets[name]
+            self.count(socket, self.clock())  # Count the time so far at the old wattage
+            socket.watts = watts
+
+    def set_state(self, name, on, when=None):
+        when = self.clock() if when is None else when
+        with self.lock:
+            socket = self.sockets[name]
+            if on:
+                if socket.on_since is None:
+                    socket.on_since = when
+            elif socket.on_since is not None:
+                self.count(socket, when)
+                socket.on_since = None
+
+    # Move a socket's on time up to now into the pending hourly totals, split at the hour boundaries
+    def count(self, socket, now):
+        if socket.on_since is None:
+            return
+        start = socket.on_since
+        while start < now:
+            local = time.localtime(start)
+            hour_end = min(now, start - local.tm_min * 60 - local.tm_sec - start % 1 + 3600)
+            seconds = hour_end - start
+            totals = self.pending.setdefault((time.strftime("%Y-%m-%d %H", local), socket.name), [0.0, 0.0])
+            totals[0] += seconds
+            totals[1] += seconds * socket.watts / 3600
+            start = hour_end
+        socket.on_since = now
+
+    def flush_if_due(self):
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    # Write the pending totals to the database, adding them to each period's row in one transaction
+    # (Holds the lock throughout, so the totals are never counted twice or missed while being written)
+    def flush(self):
+        self.last_flush = time.monotonic()
+        with self.lock:
+            now = self.clock()
+            for socket in self.sockets.values():
+                self.count(socket, now)
+            if self.db_file is None:
+                # Nowhere to keep them, so only hold on to this month
+                month = time.strftime("%Y-%m", time.localtime(now))
+                self.pending = {key: totals for key, totals in self.pending.items() if key[0][:7] == month}
+                return
+            if not self.pending:
+                return
+
+            try:
+                conn = self.connect()
+                with conn:
+                    for table, column, length in PERIODS:
+                        totals = {}
+                        for (hour, name), (seconds, watt_hours) in self.pending.items():
+                            entry = totals.setdefault((hour[:length], name), [0.0, 0.0])
+                            entry[0] += seconds
+                            entry[1] += watt_hours
+                        conn.executemany(f"INSERT INTO {table} ({column}, Socket, Seconds, WattHours) "
+                                         f"VALUES (?, ?, ?, ?) ON CONFLICT ({column}, Socket) "
+                                         "DO UPDATE SET Seconds = Seconds + excluded.Seconds, "
+                                         "WattHours = WattHours + excluded.WattHours",
+                                         [key + tuple(entry) for key, entry in totals.items()])
+                self.pending = {}
+            except sqlite3.Error as e:
+                self.logger.error(f"Could not write energy totals, will try again: {e}")
+                self.disconnect()
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+        return self.conn
+
+    def disconnect(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    # Totals for a day ("YYYY-MM-DD") and a month ("YYYY-MM"), from the stored row for each plus whatever hasn't
+    # been written yet. Returns {period: {socket name: (seconds, watt hours)}}
+    def get_totals(self, day, month):
+        totals = {}
+        with self.lock:
+            now = self.clock()
+            for socket in self.sockets.values():
+                self.count(socket, now)
+            conn = self.connect() if self.db_file is not None else None
+            for period, key, (table, column, length) in (("day", day, PERIODS[1]), ("month", month, PERIODS[2])):
+                values = {name: [0.0, 0.0] for name in self.sockets}
+                rows = conn.execute(f"SELECT Socket, Seconds, WattHours FROM {table} WHERE {column} = ?",
+                                    (key,)).fetchall() if conn is not None else []
+                rows += [(name, seconds, watt_hours) for (hour, name), (seconds, watt_hours) in self.pending.items()
+                         if hour[:length] == key]
+                for name, seconds, watt_hours in rows:
+                    entry = values.setdefault(name, [0.0, 0.0])
+                    entry[0] += seconds
+                    entry[1] += watt_hours
+                totals[period] = {name: tuple(entry) for name, entry in values.items()}
+        return totals
@@ -0,0 +1,113 @@
+# Event log export module
+# Streams the event log as newline delimited JSON or CSV from a read-only snapshot
+# Can also be run on its own against the database file:
+#   python3 -m lib.eventexport --format csv --start 2020-01-01 --end 2020-02-01 event_log.db > events.csv
+
+import argparse  # Used for the command line interface
+import csv  # Used for formatting CSV output
+import io  # Used for building CSV chunks in memory
+import json  # Used for formatting JSON output
+import os  # Used for building the read-only database URI
+import sqlite3  # Used for accessing the event log database
+import sys  # Used for writing to standard output
+from datetime import datetime  # Used for checking time range values
+
+# Setup constants
+FETCH_SIZE = 500  # How many rows to fetch and format at a time (int)
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}  # Export formats and their content types
+SOURCES = {  # Tables that can be exported, with the column used for the time range
+    "events": ("EventLog", "Timestamp",
+               ["EventID", "Timestamp", "TriggerCode", "TriggerDetails", "ResponseCode", "ResponseDetails",
+                "Automated"]),
+    "daily": ("EventDaily", "Day", ["Day", "TriggerCode", "ResponseCode", "Automated", "Count"])}
+
+
+# Convert a time range value to the format stored in the database, None if not given
+def parse_time(value):
+    if value is None or value == "":
+        return None
+    return datetime.fromisoformat(value).strftime("%Y-%m-%d %H:%M:%S")
+
+
+# Open a read-only connection, every row is read inside one transaction so the export sees a single snapshot
+# (with write-ahead logging this never blocks the writer)
+def open_snapshot(db_file):
+    uri = "file:" + os.path.abspath(db_file) + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, timeout=30, check_same_thread=False)
+    conn.isolation_level = None
+    conn.execute("BEGIN")
+    return conn
+
+
+# Yield rows a batch at a time so memory use stays the same however many rows there are
+def iter_rows(conn, source="events", start=None, end=None):
+    table, time_column, columns = SOURCES[source]
+    sql = "SELECT " + ", ".join(columns) + " FROM " + table
+    conditions = []
+    parameters = []
+    if start is not None:
+        conditions.append(time_column + " >= ?")
+        parameters.append(start if source == "events" else start[:10])
+    if end is not None:
+        conditions.append(time_column + " < ?")
+        parameters.append(end if source == "events" else end[:10])
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY " + time_column
+    cur = conn.execute(sql, parameters)
+    while True:
+        rows = cur.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        yield columns, rows
+
+
+def format_ndjson(batches):
+    for columns, rows in batches:
+        yield "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+
+
+def format_csv(batches):
+    header = False
+    for columns, rows in batches:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if not header:
+            writer.writerow(columns)
+            header = True
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+
+# Generator that opens a snapshot, streams it in the given format and always closes the connection
+def export(db_file, export_format="ndjson", source="events", start=None, end=None):
+    conn = open_snapshot(db_file)
+    try:
+        batches = iter_rows(conn, source, start, end)
+        if export_format == "csv":
+            yield from format_csv(batches)
+        else:
+            yield from format_ndjson(batches)
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the cabin event log")
+    parser.add_argument("database", nargs="?", default="event_log.db", help="event log database file")
+    parser.add_argument("--format", choices=FORMATS, default="ndjson", help="output format")
+    parser.add_argument("--source", choices=SOURCES, default="events", help="raw events or daily aggregates")
+    parser.add_argument("--start", help="earliest time to export (ISO format, UTC)")
+    parser.add_argument("--end", help="time to export up to (ISO format, UTC)")
+    arguments = parser.parse_args()
+    try:
+        start = parse_time(arguments.start)
+        end = parse_time(arguments.end)
+    except ValueError as e:
+        parser.error(str(e))
+    for chunk in export(arguments.database, arguments.format, arguments.source, start, end):
+        sys.stdout.write(chunk)
+
+
+if __name__ == "__main__":
+    main()
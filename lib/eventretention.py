@@ -0,0 +1,194 @@
+# Event log retention module
+# Summarises old event log rows into daily aggregates, archives them to compressed monthly files and deletes them
+
+import gzip  # Used for compressing the monthly archive files
+import json  # Used for writing archived rows
+import os  # Used for creating the archive directory
+import sqlite3  # Used for accessing the event log database
+import threading  # Used for running the job alongside the rest of the program
+
+# Setup constants
+RETENTION_DAYS = 90  # How many days of raw rows to keep (int)
+BATCH_SIZE = 500  # How many rows to archive and delete per transaction (int)
+BATCH_PAUSE = 0.5  # How long to pause between batches so writers get a turn (seconds)
+VACUUM_PAGES = 100  # How many free pages to release per incremental vacuum step (int)
+RUN_INTERVAL = 3600  # How often the job runs (seconds)
+ARCHIVE_DIRECTORY = "event_archive"  # Where the monthly archive files are written (str)
+PENDING_FILE_NAME = "pending.json"  # The batch waiting to be archived once it has been deleted, in the archive directory (str)
+COLUMNS = ["EventID", "Timestamp", "TriggerCode", "TriggerDetails", "ResponseCode", "ResponseDetails", "Automated"]
+
+
+# Set up the database for retention, only needs doing once per database file
+def setup_database(db_file, logger):
+    conn = sqlite3.connect(db_file, timeout=30)
+    try:
+        # Write-ahead logging lets readers and the retention job run without blocking the writer
+        conn.execute("PRAGMA journal_mode=WAL")
+
+        # Incremental vacuum has to be switched on with one full vacuum before it works
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logger.info("Switching event log database to incremental vacuum (one-off full vacuum)")
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS EventDaily (
+                Day DATE NOT NULL,
+                TriggerCode CHAR (7) REFERENCES Triggers (TriggerCode) NOT NULL,
+                ResponseCode CHAR (7) REFERENCES Responses (ResponseCode) NOT NULL,
+                Automated BOOLEAN NOT NULL,
+                Count INTEGER NOT NULL,
+                PRIMARY KEY (Day, TriggerCode, ResponseCode, Automated))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS EventLogTimestamp ON EventLog (Timestamp)")
+    finally:
+        conn.close()
+
+
+# The job works through old rows in small batches, each in its own short transaction, so the
+# event writer is never locked out for more than one batch. Freed pages are handed back with
+# small incremental vacuum steps rather than a full vacuum.
+class EventRetention(threading.Thread):
+    def __init__(self, db_file, logger, retention_days=RETENTION_DAYS, archive=True,
+                 archive_directory=ARCHIVE_DIRECTORY, run_interval=RUN_INTERVAL):
+        threading.Thread.__init__(self, name="retention", daemon=True)
+        self.db_file = db_file
+        self.logger = logger
+        self.retention_days = retention_days
+        self.archive = archive
+        self.archive_directory = archive_directory
+        self.run_interval = run_interval
+        self.stoprequest = threading.Event()
+
+    def stop(self):
+        self.logger.debug("Stopping the event retention job")
+        self.stoprequest.set()
+
+    def run(self):
+        self.logger.debug("Running the event retention job")
+
+        # Run the thread until stoprequest is set
+        while not self.stoprequest.is_set():
+            try:
+                self.run_once()
+            except (sqlite3.Error, OSError) as e:
+                self.logger.error(f"Event retention job failed: {e}")
+            self.stoprequest.wait(self.run_interval)
+
+    # Process every row past the retention window, returns how many rows were removed
+    def run_once(self):
+        total = 0
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        try:
+            # Worked out once, so every batch (and the select and delete within one) uses the same cutoff
+            cutoff = conn.execute("SELECT datetime('now', ?)", (f"-{self.retention_days} days",)).fetchone()[0]
+            if self.archive:
+                self.archive_pending(conn)  # A batch left over from a run that stopped part way through
+            while not self.stoprequest.is_set():
+                removed = self.process_batch(conn, cutoff)
+                if removed == 0:
+                    break
+                total += removed
+                self.stoprequest.wait(BATCH_PAUSE)
+            if total:
+                self.logger.info(f"Event retention job summarised and removed {total} rows")
+            self.vacuum(conn)
+        finally:
+            conn.close()
+        return total
+
+    # Summarise, archive and delete one batch of rows older than cutoff ("YYYY-MM-DD HH:MM:SS" UTC)
+    def process_batch(self, conn, cutoff):
+        rows = conn.execute("SELECT " + ", ".join(COLUMNS) + " FROM EventLog "
+                            "WHERE Timestamp < ? ORDER BY EventID LIMIT ?",
+                            (cutoff, BATCH_SIZE)).fetchall()
+        if not rows:
+            return 0
+
+        # Count rows per day
+        aggregates = {}
+        for row in rows:
+            key = (row[1][:10], row[2], row[4], row[6])
+            aggregates[key] = aggregates.get(key, 0) + 1
+
+        # The rows are written to the pending file first and only appended to the archive once the delete has
+        # committed, so a failed transaction never leaves them archived and a failed archive write never loses them
+        if self.archive:
+            self.write_pending(rows)
+
+        # Add to the aggregates and delete exactly the selected rows in one transaction
+        try:
+            with conn:
+                conn.executemany("INSERT INTO EventDaily (Day, TriggerCode, ResponseCode, Automated, Count) "
+                                 "VALUES (?, ?, ?, ?, ?) ON CONFLICT (Day, TriggerCode, ResponseCode, Automated) "
+                                 "DO UPDATE SET Count = Count + excluded.Count",
+                                 [key + (count,) for key, count in aggregates.items()])
+                conn.executemany("DELETE FROM EventLog WHERE EventID = ?", [(row[0],) for row in rows])
+        except sqlite3.Error:
+            if self.archive:
+                os.remove(self.get_pending_file_name())
+            raise
+        if self.archive:
+            self.archive_pending(conn)
+        return len(rows)
+
+    def get_pending_file_name(self):
+        return os.path.join(self.archive_directory, PENDING_FILE_NAME)
+
+    def write_pending(self, rows):
+        os.makedirs(self.archive_directory, exist_ok=True)
+        self.save_pending({"rows": [dict(zip(COLUMNS, row)) for row in rows], "started": {}, "done": []})
+
+    # Replace the pending file in one step, so it is never left half written
+    def save_pending(self, pending):
+        file_name = self.get_pending_file_name()
+        with open(file_name + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(pending, file)
+        os.replace(file_name + ".tmp", file_name)
+
+    # Append the pending batch to the archive if its rows have been deleted (otherwise the delete never committed,
+    # and the rows will be picked up again by a later batch), then remove it. The size of each month's file is
+    # recorded before appending to it, and anything past that is cut off before trying again, so a batch is only
+    # ever archived once however many times this is interrupted.
+    def archive_pending(self, conn):
+        file_name = self.get_pending_file_name()
+        try:
+            with open(file_name, "r", encoding="utf-8") as file:
+                pending = json.load(file)
+        except FileNotFoundError:
+            return
+        event_ids = [row["EventID"] for row in pending["rows"]]
+        remaining = conn.execute(f"SELECT COUNT(*) FROM EventLog WHERE EventID IN ({', '.join('?' * len(event_ids))})",
+                                 event_ids).fetchone()[0] if event_ids else 0
+        if remaining == 0:
+            months = {}
+            for row in pending["rows"]:
+                months.setdefault(row["Timestamp"][:7], []).append(row)
+            for month in sorted(months):
+                if month in pending["done"]:
+                    continue
+                archive_file_name = os.path.join(self.archive_directory, f"eventlog-{month}.ndjson.gz")
+                if month not in pending["started"]:
+                    pending["started"][month] = os.path.getsize(archive_file_name) if os.path.exists(archive_file_name) else 0
+                    self.save_pending(pending)
+                self.write_archive(archive_file_name, pending["started"][month], months[month])
+                pending["done"].append(month)
+                self.save_pending(pending)
+        os.remove(file_name)
+
+    # Append rows to a month's archive file after cutting it back to size (each append is a new gzip member, which
+    # gzip reads as one file)
+    def write_archive(self, file_name, size, rows):
+        with open(file_name, "ab") as raw_file:
+            raw_file.truncate(size)
+            with gzip.GzipFile(fileobj=raw_file, mode="ab") as file:
+                for row in rows:
+                    file.write((json.dumps(row) + "\n").encode("utf-8"))
+
+    # Release free pages a few at a time so each step only holds the write lock briefly
+    def vacuum(self, conn):
+        while not self.stoprequest.is_set():
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if free_pages == 0:
+                break
+            conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+            self.stoprequest.wait(BATCH_PAUSE)
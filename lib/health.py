@@ -0,0 +1,153 @@
+# Health module
+# A watchdog that notices when a part of the program stops working (the main code loop hangs, a sensor keeps
+# failing, a radio transmit never finishes) and drives the actuators to a safe state
+
+import functools  # Used for wrapping watched functions
+import itertools  # Used for numbering running operations
+import threading  # Used for running the watchdog alongside the rest of the program
+import time  # Used for timing heartbeats and operations
+from contextlib import contextmanager  # Used for wrapping watched operations
+
+# Setup constants
+CHECK_INTERVAL = 1  # Time between checks (seconds)
+
+
+class Component:
+    def __init__(self, name, max_age, fail_safe, operation):
+        self.name = name
+        self.max_age = max_age  # Seconds without a heartbeat, or that one operation can run, before it is stale
+        self.fail_safe = fail_safe  # Called with the component name when it goes stale, or None
+        self.operation = operation  # True if watched by how long operations take rather than by heartbeats
+        self.last_beat = time.monotonic()  # Counted from registering, so there is time to start up
+        self.running = {}  # Operation number to monotonic start time
+        self.stale = False
+        self.stale_count = 0  # How many times it has gone stale
+        self.fault_until = None  # Monotonic time an injected fault ends
+
+
+# Components either send heartbeats (the main code loop, sensors) or wrap each operation (radio transmits), and
+# a check goes stale when the heartbeat is too old or an operation has run too long. A check is only a few
+# subtractions per component, so it can run every second.
+class Watchdog(threading.Thread):
+    def __init__(self, check_interval=CHECK_INTERVAL):
+        threading.Thread.__init__(self, name="watchdog", daemon=True)
+        self.logger = None  # Set by setup()
+        self.check_interval = check_interval
+        self.components = {}
+        self.counter = itertools.count()
+        self.stoprequest = threading.Event()
+        self.wakeup = threading.Event()
+        self.checks = 0
+
+    def setup(self, logger):
+        self.logger = logger
+
+    def register(self, name, max_age, fail_safe=None, operation=False):
+        self.components[name] = Component(name, max_age, fail_safe, operation)
+
+    def set_max_age(self, name, max_age):
+        self.components[name].max_age = max_age
+
+    # Record that a component is working. Ignored for unregistered components and while a fault is injected.
+    def heartbeat(self, name):
+        component = self.components.get(name)
+        if component is not None and component.fault_until is None:
+            component.last_beat = time.monotonic()
+
+    @contextmanager
+    def operation(self, name):
+        component = self.components.get(name)
+        if component is None:
+            yield
+            return
+        number = next(self.counter)
+        component.running[number] = time.monotonic()
+        try:
+            yield
+        finally:
+            del component.running[number]
+
+    # Decorator to watch every call to a function as an operation
+    def watched(self, name):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.operation(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # Make a component look like it has stopped working for a number of seconds (for testing the fail-safes in
+    # simulation): heartbeats are ignored, or an operation that never finishes is added
+    def inject_fault(self, name, seconds):
+        component = self.components[name]
+        now = time.monotonic()
+        component.fault_until = now + seconds
+        if component.operation:
+            component.running["fault"] = now
+        if self.logger is not None:
+            self.logger.warning(f"Injecting fault into {name} for {seconds} seconds")
+
+    def stop(self):
+        self.stoprequest.set()
+        self.wakeup.set()
+
+    def run(self):
+        # Run the thread until stoprequest is set
+        while not self.stoprequest.is_set():
+            self.wakeup.wait(self.check(time.monotonic()))
+            self.wakeup.clear()
+
+    # Check every component, running the fail-safe of any that have just gone stale
+    # Returns how many seconds until the next check
+    def check(self, now):
+        self.checks += 1
+        for component in list(self.components.values()):
+            if component.fault_until is not None and now >= component.fault_until:
+                component.fault_until = None
+                component.running.pop("fault", None)
+                component.last_beat = now
+            stale = self.get_age(component, now) > component.max_age
+            if stale and not component.stale:
+                component.stale = True
+                component.stale_count += 1
+                self.logger.error(f"Watchdog: {component.name} has stopped responding")
+                if component.fail_safe is not None:
+                    # In its own thread, as a fail-safe that uses the hardware could block as well
+                    threading.Thread(target=self.run_fail_safe, args=(component,), name="failsafe",
+                                     daemon=True).start()
+            elif not stale and component.stale:
+                component.stale = False
+                self.logger.info(f"Watchdog: {component.name} has recovered")
+        return self.check_interval
+
+    def run_fail_safe(self, component):
+        try:
+            component.fail_safe(component.name)
+        except Exception as e:
+            self.logger.error(f"Watchdog: fail-safe for {component.name} failed: {e}")
+
+    # Seconds since the last heartbeat, or how long the oldest running operation has taken
+    def get_age(self, component, now):
+        if component.operation:
+            running = list(component.running.values())  # Copied first, as operations finish in other threads
+            return now - min(running) if running else 0.0
+        return now - component.last_beat
+
+    def is_healthy(self):
+        return not any(component.stale for component in self.components.values())
+
+    def get_status(self):
+        now = time.monotonic()
+        status = {}
+        for component in list(self.components.values()):
+            status[component.name] = {"status": "stale" if component.stale else "ok",
+                                      "age": round(self.get_age(component, now), 1),
+                                      "max_age": component.max_age,
+                                      "stale_count": component.stale_count,
+                                      "fault_injected": component.fault_until is not None}
+        return status
+
+
+# The watchdog shared by every module
+watchdog = Watchdog()
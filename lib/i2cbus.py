@@ -0,0 +1,161 @@
+# Shared I2C bus module
+# One object owns the I2C bus, the servo and light sensor modules take turns on it through a fair lock
+
+import threading  # Used for the bus lock
+import time  # Used for measuring transaction latency
+from contextlib import contextmanager  # Used for wrapping each bus transaction
+
+### Raspberry Pi specific modules
+module_fail = False
+try:
+    import board
+    import busio
+    import adafruit_pca9685
+except ImportError:
+    module_fail = True
+
+# Setup constants
+PCA9685_FREQUENCY = 50  # Servo PWM frequency (Hz)
+PCA9685_LED0_ON_L = 0x06  # First channel register, each channel has four registers after it
+
+# Global variables for module
+shared_bus = None
+shared_bus_lock = threading.Lock()
+
+
+# Get the bus object shared by every module, creating it on first use
+def get_bus(logger, simulation=False):
+    global shared_bus
+    with shared_bus_lock:
+        if shared_bus is None:
+            shared_bus = I2CBus(logger, simulation)
+        return shared_bus
+
+
+# Ticket lock, threads get the bus in the order they asked for it so a busy servo can't starve the light sensor
+class FairLock:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.next_ticket = 0
+        self.serving = 0
+
+    def acquire(self):
+        with self.condition:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            while self.serving != ticket:
+                self.condition.wait()
+
+    def release(self):
+        with self.condition:
+            self.serving += 1
+            self.condition.notify_all()
+
+
+# Stands in for a PCA9685 channel object so the servo module can still just set duty_cycle
+class BusChannel:
+    def __init__(self, bus, number):
+        self.bus = bus
+        self.number = number
+
+    @property
+    def duty_cycle(self):
+        return self.bus.duty_cycles.get(self.number, 0)
+
+    @duty_cycle.setter
+    def duty_cycle(self, value):
+        self.bus.write_channels({self.number: value})
+
+
+class I2CBus:
+    def __init__(self, logger, simulation=False):
+        self.logger = logger
+        self.emulation_mode = simulation or module_fail
+        self.lock = FairLock()
+        self.pca = None
+        self.duty_cycles = {}  # Last duty cycle written to each PCA9685 channel
+        self.metrics = {
+            "transactions": 0,
+            "errors": 0,
+            "channel_writes": 0,
+            "total_latency": 0.0,  # Time spent holding the bus (seconds)
+            "max_latency": 0.0,
+            "total_wait": 0.0}  # Time spent waiting for the bus (seconds)
+        if self.emulation_mode:
+            self.i2c = None
+            self.logger.debug("I2C bus running in emulation mode")
+        else:
+            self.i2c = busio.I2C(board.SCL, board.SDA)
+            self.logger.debug("Initialised shared I2C bus")
+
+    # Hold the bus for one transaction, recording how long it took and if it failed
+    @contextmanager
+    def transaction(self):
+        wait_start = time.monotonic()
+        self.lock.acquire()
+        start = time.monotonic()
+        try:
+            yield self.i2c
+        except Exception:
+            self.metrics["errors"] += 1
+            raise
+        finally:
+            latency = time.monotonic() - start
+            self.metrics["transactions"] += 1
+            self.metrics["total_wait"] += start - wait_start
+            self.metrics["total_latency"] += latency
+            if latency > self.metrics["max_latency"]:
+                self.metrics["max_latency"] = latency
+            self.lock.release()
+
+    # Set up the PCA9685 servo driver once, however many servos use it
+    def get_pca9685(self):
+        if self.pca is None and not self.emulation_mode:
+            with self.transaction():
+                self.pca = adafruit_pca9685.PCA9685(self.i2c)
+                self.pca.frequency = PCA9685_FREQUENCY  # Also turns on register auto increment
+            self.logger.debug("Initialised shared PCA9685")
+        return self.pca
+
+    def channel(self, number):
+        self.get_pca9685()
+        return BusChannel(self, number)
+
+    # Write duty cycles to several PCA9685 channels, each run of neighbouring channels is sent as one transaction
+    def write_channels(self, duty_cycles):
+        self.duty_cycles.update(duty_cycles)
+        self.metrics["channel_writes"] += len(duty_cycles)
+        channels = sorted(duty_cycles)
+        runs = []
+        for channel in channels:
+            if runs and runs[-1][-1] == channel - 1:
+                runs[-1].append(channel)
+            else:
+                runs.append([channel])
+
+        for run in runs:
+            buffer = bytearray([PCA9685_LED0_ON_L + 4 * run[0]])
+            for channel in run:
+                buffer += self.encode(duty_cycles[channel])
+            with self.transaction():
+                if not self.emulation_mode:
+                    with self.pca.i2c_device as device:
+                        device.write(buffer)
+
+    # Turn a 16 bit duty cycle into the four ON/OFF register bytes (same conversion as the Adafruit library)
+    @staticmethod
+    def encode(duty_cycle):
+        if duty_cycle == 0xffff:
+            on, off = 0x1000, 0
+        else:
+            on, off = 0, (duty_cycle + 1) >> 4
+        return bytes([on & 0xff, on >> 8, off & 0xff, off >> 8])
+
+    def get_metrics(self):
+        metrics = dict(self.metrics)
+        if metrics["transactions"]:
+            metrics["average_latency"] = metrics["total_latency"] / metrics["transactions"]
+        else:
+            metrics["average_latency"] = 0.0
+        metrics["emulation_mode"] = self.emulation_mode
+        return metrics
@@ -3,15 +3,17 @@
 
 # Import libraries
 try:
-    import board
-    import busio
     import adafruit_tsl2591
     module_fail = False
 except ModuleNotFoundError:
     module_fail = True
 
+from lib import i2cbus
+
 
 class LightSensor:
+    __slots__ = ("emulation_mode", "logger", "emulation_values", "bus", "sensor", "emu_gain", "emu_integration_time")
+
     def __init__(self, logger, gain="med", integration_time=100):
         self.emulation_mode = module_fail
         self.logger = logger
@@ -25,8 +27,10 @@ class LightSensor:
                 "raw_luminosity": 50}
             self.logger.debug("Running in emulation mode")
         else:
-            self.i2c = busio.I2C(board.SCL, board.SDA)
-            self.sensor = adafruit_tsl2591.TSL2591(self.i2c)
+            # Use the shared bus so sensor reads don't collide with servo writes
+            self.bus = i2cbus.get_bus(logger)
+            with self.bus.transaction() as i2c:
+                self.sensor = adafruit_tsl2591.TSL2591(i2c)
         self.set_gain(gain)
         self.set_integration_time(integration_time)
 
@@ -36,16 +40,17 @@ class LightSensor:
             if self.emulation_mode:
                 return self.emulation_values[measurement]
             else:
-                if measurement == "lux":
-                    return self.sensor.lux
-                elif measurement == "visible":
-                    return self.sensor.visible
-                elif measurement == "infrared":
-                    return self.sensor.infrared
-                elif measurement == "full_spectrum":
-                    return self.sensor.full_spectrum
-                elif measurement == "raw_luminosity":
-                    return self.sensor.raw_luminosity
+                with self.bus.transaction():
+                    if measurement == "lux":
+                        return self.sensor.lux
+                    elif measurement == "visible":
+                        return self.sensor.visible
+                    elif measurement == "infrared":
+                        return self.sensor.infrared
+                    elif measurement == "full_spectrum":
+                        return self.sensor.full_spectrum
+                    elif measurement == "raw_luminosity":
+                        return self.sensor.raw_luminosity
         else:
             raise ValueError("Specified measurement value not valid.")
 
@@ -67,7 +72,8 @@ class LightSensor:
             if self.emulation_mode:
                 self.emu_gain = gains[gain]
             else:
-                self.sensor.gain = gains[gain]
+                with self.bus.transaction():
+                    self.sensor.gain = gains[gain]
         else:
             raise ValueError("Specified gain value not valid.")
 
@@ -93,6 +99,7 @@ class LightSensor:
             if self.emulation_mode:
                 self.emu_integration_time = integration_times[integration_time]
             else:
-                self.sensor.integration_time = integration_times[integration_time]
+                with self.bus.transaction():
+                    self.sensor.integration_time = integration_times[integration_time]
         else:
             raise ValueError("Specified integration time value not valid.")
@@ -0,0 +1,246 @@
+# Load test module
+# Replays a mix of control panel traffic against a running server, to size how many panels and automations
+# one Pi can serve before the main code loop starts slipping. Run it against a server in simulation mode:
+#   CABIN_SIMULATION=1 python3 log_cabin_control_server.py
+#   python3 -m lib.loadtest --concurrency 8 --rate 50 --duration 60
+
+import argparse  # Used for the command line interface
+import json  # Used for encoding requests and decoding responses
+import random  # Used for picking requests from the mix
+import threading  # Used for running the clients and the loop monitor side by side
+import time  # Used for pacing and timing requests
+import urllib.error  # Used for catching HTTP errors
+import urllib.request  # Used for sending requests
+
+# Setup constants
+DEFAULT_URL = "http://localhost:7890"  # Where the server is running (str)
+DEFAULT_MIX = "getheating=40,getblinds=40,setblind=10,setdesiredtemp=5,setheatingmode=5"  # Request weights (str)
+TIMEOUT = 30  # Longest to wait for a response (seconds)
+MONITOR_INTERVAL = 1  # Time between main code loop statistics checks (seconds)
+BLINDS = ["left", "leftdoor", "rightdoor", "right"]
+PERCENTILES = [50, 90, 99]
+
+
+# Build the method, path and JSON body for one request of a kind
+def build_request(kind):
+    if kind == "getheating":
+        return "GET", "/cabinapi/getheating", None
+    if kind == "getblinds":
+        return "GET", "/cabinapi/getblinds", None
+    if kind == "setblind":
+        return "POST", "/cabinapi/setblind", {"blind": random.choice(BLINDS), "percent": random.choice([0, 25, 50, 75, 100])}
+    if kind == "setdesiredtemp":
+        return "POST", "/cabinapi/setdesiredtemp", {"action": random.choice(["increase", "decrease"])}
+    if kind == "setheatingmode":
+        return "POST", "/cabinapi/setheatingmode", {"mode": random.choice(["auto", "manual"])}
+    raise ValueError(f"Unknown request \"{kind}\"")
+
+
+# Parse "name=weight,..." into a list of names and a list of weights
+def parse_mix(value):
+    names, weights = [], []
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        build_request(name)  # Raises ValueError for unknown names
+        names.append(name)
+        weights.append(float(weight) if weight else 1.0)
+    if sum(weights) <= 0:
+        raise ValueError("Request weights must add up to more than 0")
+    return names, weights
+
+
+# Nearest rank percentile of a sorted list
+def percentile(values, percent):
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(percent / 100 * len(values) + 0.5)) - 1))]
+
+
+# Hands out send times to every client, so the total rate stays fixed however many clients there are.
+# Latency is timed from the scheduled send time rather than the actual one, so a slow server can't hide
+# its queueing delay by holding the clients back (coordinated omission).
+class Schedule:
+    def __init__(self, rate, end):
+        self.interval = 1 / rate if rate else 0
+        self.end = end
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Returns the time the next request should be sent, or None once the test is over
+    def take(self):
+        with self.lock:
+            if self.interval:
+                send_time = self.next_time
+                self.next_time += self.interval
+            else:
+                send_time = time.monotonic()
+        if send_time >= self.end:
+            return None
+        return send_time
+
+
+class Client(threading.Thread):
+    def __init__(self, url, schedule, names, weights, results):
+        threading.Thread.__init__(self, daemon=True)
+        self.url = url
+        self.schedule = schedule
+        self.names = names
+        self.weights = weights
+        self.results = results  # Shared list of (kind, status, latency) tuples, list.append is atomic
+        self.etags = {}  # Last ETag seen for each getter, sent back like a panel would
+
+    def run(self):
+        while True:
+            send_time = self.schedule.take()
+            if send_time is None:
+                return
+            delay = send_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            kind = random.choices(self.names, self.weights)[0]
+            status = self.send(kind)
+            self.results.append((kind, status, time.monotonic() - send_time))
+
+    # Send one request, returns the HTTP status (0 for a connection error)
+    def send(self, kind):
+        method, path, body = build_request(kind)
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method)
+        if data is not None:
+            request.add_header("Content-Type", "application/json")
+        if kind in self.etags:
+            request.add_header("If-None-Match", self.etags[kind])
+        try:
+            with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                response.read()
+                if response.headers.get("ETag"):
+                    self.etags[kind] = response.headers["ETag"]
+                return response.status
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return 304
+            return e.code
+        except (urllib.error.URLError, OSError):
+            return 0
+
+
+# Polls the main code loop statistics while the test runs, collecting how late each loop started
+class LoopMonitor(threading.Thread):
+    def __init__(self, url):
+        threading.Thread.__init__(self, daemon=True)
+        self.url = url
+        self.stoprequest = threading.Event()
+        self.cycles = None
+        self.lateness = []  # Lateness of each loop seen during the test (seconds)
+        self.durations = []  # Duration of each loop seen during the test (seconds)
+        self.rule_runs = None
+        self.rule_runs_end = None
+
+    def get_statistics(self):
+        try:
+            with urllib.request.urlopen(self.url + "/cabinapi/getloopstats", timeout=TIMEOUT) as response:
+                return json.load(response)
+        except (urllib.error.URLError, OSError, ValueError):
+            return None
+
+    def run(self):
+        first = self.get_statistics()
+        if first is None:
+            return
+        self.cycles = first["statistics"]["cycles"]
+        self.rule_runs = first["rules"]["rule_runs"]
+        self.rule_runs_end = self.rule_runs
+        while not self.stoprequest.wait(MONITOR_INTERVAL):
+            self.check()
+        self.check()
+
+    def check(self):
+        current = self.get_statistics()
+        if current is None:
+            return
+        statistics = current["statistics"]
+        if statistics["cycles"] != self.cycles:
+            self.cycles = statistics["cycles"]
+            self.lateness.append(statistics["last_lateness"])
+            self.durations.append(statistics["last_duration"])
+        self.rule_runs_end = current["rules"]["rule_runs"]
+
+    def stop(self):
+        self.stoprequest.set()
+
+
+def report(results, elapsed, monitor):
+    if results:
+        report_requests(results, elapsed)
+    else:
+        print("No requests were sent")
+    report_loop(monitor)
+
+
+def report_requests(results, elapsed):
+    print(f"{len(results)} requests in {elapsed:.1f} seconds, {len(results) / elapsed:.1f} requests/second")
+    print(f"{'request':<16}{'count':>8}{'errors':>8}{'304s':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    kinds = sorted(set(kind for kind, _, _ in results))
+    for kind in kinds + ["all"]:
+        selected = [result for result in results if kind == "all" or result[0] == kind]
+        latencies = sorted(latency * 1000 for _, _, latency in selected)
+        errors = sum(1 for _, status, _ in selected if status == 0 or status >= 400)
+        not_modified = sum(1 for _, status, _ in selected if status == 304)
+        print(f"{kind:<16}{len(selected):>8}{errors:>8}{not_modified:>8}"
+              + "".join(f"{percentile(latencies, percent):>10.1f}" for percent in PERCENTILES)
+              + f"{latencies[-1]:>10.1f}")
+    errors = sum(1 for _, status, _ in results if status == 0 or status >= 400)
+    print(f"Error rate {errors / len(results) * 100:.2f}%")
+
+
+def report_loop(monitor):
+    if monitor.cycles is None:
+        print("Main code loop statistics not available")
+    elif not monitor.lateness:
+        print("No main code loops ran during the test, run for longer or lower loop_interval in the config")
+    else:
+        print(f"Main code loop: {len(monitor.lateness)} loops, "
+              f"lateness mean {sum(monitor.lateness) / len(monitor.lateness) * 1000:.1f} ms "
+              f"max {max(monitor.lateness) * 1000:.1f} ms, "
+              f"duration max {max(monitor.durations) * 1000:.1f} ms, "
+              f"{monitor.rule_runs_end - monitor.rule_runs} rule runs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the cabin API")
+    parser.add_argument("--url", default=DEFAULT_URL, help="server to test")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of clients sending requests at once")
+    parser.add_argument("--rate", type=float, default=20, help="total requests per second (0 for as fast as possible)")
+    parser.add_argument("--duration", type=float, default=30, help="how long to run for (seconds)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="request weights, name=weight separated by commas")
+    parser.add_argument("--seed", type=int, help="random seed, to replay the same requests")
+    arguments = parser.parse_args()
+    try:
+        names, weights = parse_mix(arguments.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if arguments.concurrency < 1 or arguments.rate < 0 or arguments.duration <= 0:
+        parser.error("concurrency and duration must be positive, rate must not be negative")
+    if arguments.seed is not None:
+        random.seed(arguments.seed)
+    url = arguments.url.rstrip("/")
+
+    monitor = LoopMonitor(url)
+    monitor.start()
+    results = []
+    start = time.monotonic()
+    schedule = Schedule(arguments.rate, start + arguments.duration)
+    clients = [Client(url, schedule, names, weights, results) for _ in range(arguments.concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.monotonic() - start
+    monitor.stop()
+    monitor.join()
+    report(results, elapsed, monitor)
+
+
+if __name__ == "__main__":
+    main()
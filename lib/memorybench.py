@@ -0,0 +1,260 @@
+# Memory benchmark module
+# Runs the control core's long lived objects through weeks of simulated time as fast as possible and samples the
+# process's resident memory once a simulated day, to check nothing grows over a long uptime:
+#   python3 -m lib.memorybench --weeks 8
+# If the server can be imported (Flask and the Dark Sky library installed), it is loaded in simulation mode in a
+# scratch directory and its own main code loop, presence monitor, event writer, API calls (through the Flask test
+# client), forecast and logging are run. Otherwise the same kinds of objects are run from the library on their own.
+
+import argparse  # Used for the command line interface
+import logging  # Used for a quiet logger for the objects under test
+import os  # Used for reading the resident memory and the page size
+import random  # Used for simulating motion and blind moves
+import resource  # Used for the peak resident memory
+import shutil  # Used for copying the event log database into the scratch directory
+import sys  # Used for importing the server from the scratch directory
+import tempfile  # Used for a scratch directory for the databases and log file
+import time  # Used for timing the run
+from datetime import datetime, timedelta  # Used for the simulated clock
+from types import SimpleNamespace  # Used for a canned forecast
+
+from lib import cabinblinds
+from lib import energenie
+from lib import energy
+from lib import health
+from lib import occupancy
+from lib import presence
+from lib import profiling
+from lib import responsecache
+from lib import rules
+from lib import solar
+from lib import tempsensor
+
+# Setup constants
+WARM_UP_DAYS = 2  # Days before the baseline is taken, so one-off allocations (caches, the solar table) are done (int)
+TOLERANCE = 256  # Growth allowed between the baseline and the end, in KiB (int)
+BLINDS = ["left", "leftdoor", "rightdoor", "right"]
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # Where the server and event log live (str)
+REQUEST_INTERVAL = 5  # Simulated minutes between each round of API calls (int)
+API_CALLS = ["/cabinapi/getheating", "/cabinapi/getblinds", "/cabinapi/health", "/cabinapi/testme",
+             "/cabinapi/energy", "/cabinapi/getpresence"]
+
+
+# Resident memory in KiB (from /proc on Linux, otherwise the peak)
+def get_rss():
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Stands in for the Dark Sky client, so the forecast is fetched and reused the same way without the network
+class ForecastClient:
+    def __init__(self):
+        self.calls = 0
+
+    def get_forecast(self, *args, **kwargs):
+        self.calls += 1
+        day = SimpleNamespace(cloud_cover=random.random(), temperature_high=round(10 + random.random() * 15, 1))
+        return SimpleNamespace(daily=SimpleNamespace(data=[day]))
+
+
+# Finishes a blind move as soon as it is started, in place of the blind service thread, so moves made by the
+# server's rules don't wait in real time
+class InstantMove:
+    def __init__(self, blind):
+        self.blind = blind
+
+    def set(self):
+        self.blind.service(self.blind.cutoff)
+
+    def clear(self):
+        pass
+
+
+# Import the server in simulation mode from the scratch directory (its log file, config and state are written there),
+# with the event log database copied in. Returns None if it can't be imported.
+def load_server(directory, clock):
+    os.environ["CABIN_SIMULATION"] = "1"
+    shutil.copy(os.path.join(REPO_DIRECTORY, "event_log.db"), directory)
+    if REPO_DIRECTORY not in sys.path:
+        sys.path.insert(0, REPO_DIRECTORY)
+    try:
+        import log_cabin_control_server as server
+    except Exception as e:  # A missing or broken dependency (the Dark Sky library fails to import on newer Pythons)
+        print(f"Server not loaded ({type(e).__name__}: {e}), only running the library objects")
+        return None
+    logging.getLogger().removeHandler(server.ch)  # Keep logging to the file, but not the console
+    server.use_database = True
+    server.add_extra_triggers(server.DATABASE_FILE_NAME)
+    energy.setup_database(server.DATABASE_FILE_NAME)
+    server.darksky_client = ForecastClient()
+
+    # Run the server's rules on the simulated clock (the occupancy model still uses the real one)
+    server.RulesObject.signals["hour"].read = lambda: clock["now"].hour
+    server.RulesObject.signals["utc_time"].read = lambda: solar.utc_minutes(clock["now"].astimezone())
+    server.EnergyObject.clock = lambda: clock["epoch"]
+    for blind in server.blind_objects.values():
+        blind.wakeup = InstantMove(blind)
+
+    # Start up as the server does
+    server.restore_state()
+    server.update_temperature()
+    server.publish_blinds()
+    return server
+
+
+def run(weeks, seed):
+    random.seed(seed)
+    logger = logging.getLogger("memorybench")
+    logger.setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        working_directory = os.getcwd()
+        os.chdir(directory)
+        try:
+            return simulate(weeks, directory, logger)
+        finally:
+            os.chdir(working_directory)
+
+
+def simulate(weeks, directory, logger):
+    # Simulated clock, advanced a minute at a time
+    clock = {"now": datetime(2020, 1, 6), "epoch": datetime(2020, 1, 6).timestamp(), "monotonic": 0.0}
+    energenie.setup(simulation=True)
+    server = load_server(directory, clock)
+    if server is not None:
+        step, finish = server_steps(server, clock)
+    else:
+        step, finish = library_steps(os.path.join(directory, "memorybench.db"), clock, logger)
+
+    samples = []
+    minutes = weeks * 7 * 24 * 60
+    started = time.monotonic()
+    for minute in range(minutes):
+        clock["now"] += timedelta(minutes=1)
+        clock["epoch"] += 60
+        clock["monotonic"] += 60
+        step(minute)
+        if minute % 1440 == 1439:
+            samples.append(get_rss())
+    finish()
+    return samples, time.monotonic() - started
+
+
+# Add motion during the day, with bursts of edges for the debounce to deal with
+def add_motion(monitor, clock):
+    if 8 <= clock["now"].hour < 22 and random.random() < 0.05:
+        for _ in range(random.randint(1, 5)):
+            monitor.events.append(clock["monotonic"] + random.random())
+
+
+# One simulated minute of the server itself: its presence monitor, a main code loop (rules, saving the state, energy
+# totals), API calls from a few panels and the daily forecast
+def server_steps(server, clock):
+    client = server.app.test_client()
+    etags = {}
+
+    def step(minute):
+        add_motion(server.PresenceObject, clock)
+        server.PresenceObject.process(clock["monotonic"] + 1)
+        tempsensor.emulation_temperature = round(18 + random.random() * 4, 1)
+        server.run_cycle()
+        server.WatchdogObject.check(time.monotonic())
+        if minute % 15 == 0:
+            server.EnergyObject.flush()  # flush_if_due goes by the real clock, so would hardly ever flush
+
+        # API calls, sending back the ETags they were given
+        if minute % REQUEST_INTERVAL == 0:
+            for path in API_CALLS:
+                headers = {"If-None-Match": etags[path]} if path in etags else {}
+                response = client.get(path, headers=headers)
+                if response.headers.get("ETag"):
+                    etags[path] = response.headers["ETag"]
+                response.close()
+        if minute % 1440 == 0:
+            server.daily_forecast["date"] = None  # A new day, so the forecast is fetched again
+            server.get_daily_forecast()
+
+    def finish():
+        with server.event_connection_lock:
+            if server.event_connection is not None:
+                server.event_connection.close()
+                server.event_connection = None
+        server.EnergyObject.disconnect()
+        server.fh.close()
+
+    return step, finish
+
+
+# One simulated minute of the same long lived objects the server keeps, for when the server can't be imported
+def library_steps(db_file, clock, logger):
+    energy.setup_database(db_file)
+    heater = energenie.device(socket_number=1, logger=logger)
+    meter = energy.EnergyMeter(db_file, logger, clock=lambda: clock["epoch"])
+    meter.add_socket("heater", 2000)
+    heater.add_listener(lambda state: meter.set_state("heater", state))
+    model = occupancy.OccupancyModel(logger)
+    monitor = presence.PresenceMonitor(logger, presence_callback=lambda present: model.record(present, clock["now"]))
+    blinds = {name: cabinblinds.blindservo(name, channel, logger, simulation=True)
+              for channel, name in enumerate(BLINDS)}
+    table = solar.SolarTable(51.456857, -1.053791, {name: 180 for name in BLINDS})
+    cache = responsecache.ResponseCache()
+    tracer = profiling.Tracer(threshold=0)  # Record every span, to fill the ring buffer
+    watchdog = health.Watchdog()
+    watchdog.setup(logger)
+    watchdog.register("scheduler", 180)
+    engine = rules.RuleEngine(logger)
+    engine.add_signal("hour", lambda: clock["now"].hour)
+    engine.add_signal("temperature", lambda: round(18 + random.random() * 4, 1))
+    engine.add_signal("present", monitor.is_present)
+    engine.add_signal("solar_day", lambda: table.get_day(clock["now"].date()))
+    engine.add_rule("heating", ["temperature"], lambda values: heater.switch(values["temperature"] < 20))
+    engine.add_rule("occupancy", ["hour"], lambda values: model.update(clock["now"]))
+
+    def step(minute):
+        add_motion(monitor, clock)
+        monitor.process(clock["monotonic"] + 1)
+
+        # One main code loop, as the server runs it
+        with tracer.span("main_loop", f"cycle {minute}"):
+            engine.tick()
+        watchdog.heartbeat("scheduler")
+        watchdog.check(time.monotonic())
+        if minute % 15 == 0:
+            meter.flush()
+            meter.get_totals(clock["now"].strftime("%Y-%m-%d"), clock["now"].strftime("%Y-%m"))
+        cache.update("heating", {"response": "OK", "status": heater.get_state(), "minute": minute % 10})
+
+        # A few blind moves a day, run to the end straight away
+        if random.random() < 0.003:
+            blind = blinds[random.choice(BLINDS)]
+            blind.set_position(random.choice([0, 50, 100]))
+            blind.service(blind.cutoff)
+        cache.update("blinds", {"response": "OK",
+                                "percents": {name: round(blind.get_percent(), 1) for name, blind in blinds.items()}})
+
+    return step, meter.disconnect
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the control core's memory stays steady over a long uptime")
+    parser.add_argument("--weeks", type=int, default=4, help="simulated weeks to run for")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    arguments = parser.parse_args()
+    if arguments.weeks < 1:
+        parser.error("weeks must be at least 1")
+
+    samples, elapsed = run(arguments.weeks, arguments.seed)
+    print(f"Simulated {arguments.weeks} weeks in {elapsed:.1f} seconds")
+    for day, rss in enumerate(samples, 1):
+        if day == 1 or day % 7 == 0:
+            print(f"Day {day:>4}: {rss} KiB")
+    baseline = samples[min(WARM_UP_DAYS, len(samples)) - 1]
+    growth = samples[-1] - baseline
+    print(f"Growth after day {WARM_UP_DAYS}: {growth} KiB ({'steady' if growth <= TOLERANCE else 'GROWING'})")
+    return 0 if growth <= TOLERANCE else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
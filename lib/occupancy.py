@@ -0,0 +1,149 @@
+# Occupancy prediction module
+# Learns how likely the cabin is to be occupied for each hour of the week from presence transitions
+
+from array import array  # Used for storing the model compactly
+from datetime import datetime, timedelta  # Used for working out which hour of the week an event is in
+import os  # Used for replacing the model file atomically
+import threading  # Used for sharing the model between the presence monitor and the control code
+
+# Setup constants
+SLOTS = 7 * 24  # One slot per hour of the week
+SMOOTHING = 0.2  # How much each finished hour moves its slot's probability (0 - 1)
+MAX_COUNT = 0xffff  # Largest observation count that fits in a slot
+
+
+def slot_of(when):
+    return when.weekday() * 24 + when.hour
+
+
+def slot_start(when):
+    return when.replace(minute=0, second=0, microsecond=0)
+
+
+# The model keeps an exponentially weighted probability of occupancy for each hour of the week.
+# Each hour is folded into its slot once when it finishes, so every update is O(1) and only the
+# open hour is held in memory. The saved file is just the two arrays (around 1 KB) so it loads instantly.
+class OccupancyModel:
+    def __init__(self, logger, smoothing=SMOOTHING):
+        self.logger = logger
+        self.smoothing = smoothing
+        self.probabilities = array("d", [0.0] * SLOTS)
+        self.counts = array("H", [0] * SLOTS)  # How many hours have been folded into each slot
+        self.present = False
+        self.current_start = None  # Start of the hour currently being recorded
+        self.occupied_seconds = 0.0  # Occupied time so far in the current hour
+        self.last_time = None  # Time the model was last advanced to
+        self.lock = threading.Lock()  # Held while changing or saving the model, as presence and the rules both change it
+
+    # Record a presence transition
+    def record(self, present, when=None):
+        if when is None:
+            when = datetime.now()
+        with self.lock:
+            self.advance(when)
+            self.present = present
+
+    # Advance the model to the given time, folding in any hours that have finished
+    def update(self, when=None):
+        if when is None:
+            when = datetime.now()
+        with self.lock:
+            self.advance(when)
+
+    # (Called with the lock held)
+    def advance(self, when):
+        if self.current_start is None:
+            self.current_start = slot_start(when)
+            self.last_time = when
+            return
+        if when <= self.last_time:
+            return
+
+        # Anything more than a week old would only overwrite the same slots again
+        if when - self.last_time > timedelta(days=7):
+            self.last_time = when - timedelta(days=7)
+            self.current_start = slot_start(self.last_time)
+            self.occupied_seconds = 0.0
+
+        current_end = self.current_start + timedelta(hours=1)
+        while when >= current_end:
+            if self.present:
+                self.occupied_seconds += (current_end - self.last_time).total_seconds()
+            self.fold(slot_of(self.current_start), self.occupied_seconds / 3600)
+            self.current_start = current_end
+            self.last_time = current_end
+            self.occupied_seconds = 0.0
+            current_end = self.current_start + timedelta(hours=1)
+        if self.present:
+            self.occupied_seconds += (when - self.last_time).total_seconds()
+        self.last_time = when
+
+    def fold(self, slot, fraction):
+        if self.counts[slot] == 0:
+            self.probabilities[slot] = fraction
+        else:
+            self.probabilities[slot] += self.smoothing * (fraction - self.probabilities[slot])
+        if self.counts[slot] < MAX_COUNT:
+            self.counts[slot] += 1
+
+    # Get the probability the cabin is occupied at the given time (None if that hour has never been seen)
+    def probability(self, when=None):
+        if when is None:
+            when = datetime.now()
+        slot = slot_of(when)
+        if self.counts[slot] == 0:
+            return None
+        return self.probabilities[slot]
+
+    # Scale the presence timeout between the minimum and maximum by the occupancy probability
+    def get_timeout(self, default, minimum, maximum, when=None):
+        probability = self.probability(when)
+        if probability is None:
+            return default
+        return minimum + (maximum - minimum) * probability
+
+    # See if the cabin is likely to be occupied at some point within the next few hours
+    def arrival_expected(self, hours, threshold, when=None):
+        if when is None:
+            when = datetime.now()
+        for hour in range(1, hours + 1):
+            probability = self.probability(when + timedelta(hours=hour))
+            if probability is not None and probability >= threshold:
+                return True
+        return False
+
+    def get_summary(self, when=None):
+        probability = self.probability(when)
+        return {"probability": None if probability is None else round(probability, 3),
+                "hours_learned": sum(1 for count in self.counts if count)}
+
+    def load(self, file_name):
+        try:
+            with open(file_name, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            self.logger.debug("No occupancy model file, starting with an empty model")
+            return False
+        probabilities = array("d")
+        counts = array("H")
+        size = probabilities.itemsize * SLOTS
+        if len(data) != size + counts.itemsize * SLOTS:
+            self.logger.warning("Occupancy model file is the wrong size, starting with an empty model")
+            return False
+        probabilities.frombytes(data[:size])
+        counts.frombytes(data[size:])
+        with self.lock:
+            self.probabilities = probabilities
+            self.counts = counts
+        self.logger.debug("Loaded occupancy model")
+        return True
+
+    def save(self, file_name):
+        with self.lock:
+            data = self.probabilities.tobytes() + self.counts.tobytes()
+        temp_file_name = file_name + ".tmp"
+        with open(temp_file_name, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file_name, file_name)
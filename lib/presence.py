@@ -0,0 +1,129 @@
+# Presence detection module for the cabin PIR motion sensor
+# Turns raw rising edges from the motion sensor into debounced, coalesced presence transitions
+
+import collections  # Used for the event queue between the interrupt and the worker thread
+import threading  # Used for running the worker alongside the rest of the program
+import time  # Used for timestamping motion events
+
+# Setup constants
+DEBOUNCE_TIME = 2  # Edges closer together than this are treated as one (seconds)
+HOLD_TIME = 1800  # How long presence is held after the last motion (seconds)
+MAX_WAIT = 1  # Longest the worker sleeps before checking for a stop request (seconds)
+MAX_QUEUED = 1000  # Most edges held waiting for the worker, the oldest are dropped if a faulty sensor floods it (int)
+
+
+# The interrupt handler only timestamps the edge and appends it to a deque (append is atomic, so no lock is needed).
+# All the slow work (debouncing, switching devices, writing to the database) happens in this worker thread instead.
+class PresenceMonitor(threading.Thread):
+    def __init__(self, logger, presence_callback=None, level_callback=None,
+                 debounce_time=DEBOUNCE_TIME, hold_time=HOLD_TIME):
+        threading.Thread.__init__(self, name="presence", daemon=True)
+        self.logger = logger
+        self.presence_callback = presence_callback  # Called with True / False on each presence transition
+        self.level_callback = level_callback  # Returns the current sensor level, used to extend presence
+        self.debounce_time = debounce_time
+        self.hold_time = hold_time
+        self.stoprequest = threading.Event()
+        self.wakeup = threading.Event()
+        self.events = collections.deque(maxlen=MAX_QUEUED)
+        self.present = False
+        self.last_motion = None  # Monotonic time of the last accepted edge
+        self.last_change = None  # Monotonic time of the last presence transition
+        self.statistics = {
+            "edges": 0,  # Edges received from the interrupt
+            "debounced": 0,  # Edges discarded by the debounce
+            "arrivals": 0,  # Transitions to present
+            "departures": 0,  # Transitions to absent
+            "occupied_seconds": 0.0}  # Total time spent present (completed periods only)
+
+    # Interrupt handler, runs in the RPi.GPIO callback thread so must stay as short as possible
+    def interrupt(self, pin):
+        self.events.append(time.monotonic())
+        self.wakeup.set()
+
+    def set_debounce_time(self, debounce_time):
+        self.debounce_time = debounce_time
+
+    def set_hold_time(self, hold_time):
+        self.hold_time = hold_time
+        self.wakeup.set()  # Re-check the hold with the new value
+
+    # Carry on with presence from before a restart, held for a full hold time from now
+    def restore_presence(self):
+        self.present = True
+        self.last_motion = time.monotonic()
+        self.last_change = self.last_motion
+        self.wakeup.set()
+
+    def is_present(self):
+        return self.present
+
+    def get_statistics(self):
+        statistics = dict(self.statistics)
+        statistics["present"] = self.present
+        statistics["queued"] = len(self.events)
+        if self.present and self.last_change is not None:
+            statistics["occupied_seconds"] += time.monotonic() - self.last_change
+        if self.last_motion is not None:
+            statistics["seconds_since_motion"] = round(time.monotonic() - self.last_motion, 1)
+        else:
+            statistics["seconds_since_motion"] = None
+        statistics["hold_time"] = self.hold_time
+        return statistics
+
+    def stop(self):
+        self.logger.debug("Stopping the presence monitor")
+        self.stoprequest.set()
+        self.wakeup.set()
+
+    def run(self):
+        self.logger.debug("Running the presence monitor")
+
+        # Run the thread until stoprequest is set
+        while not self.stoprequest.is_set():
+            self.wakeup.wait(self.process(time.monotonic()))
+            self.wakeup.clear()
+
+    # Drain the queue and update the presence state, returns how long until the next check is needed
+    def process(self, now):
+        # Debounce all queued edges, only the first edge of an arrival causes a transition
+        while self.events:
+            event_time = self.events.popleft()
+            self.statistics["edges"] += 1
+            if self.last_motion is not None and event_time - self.last_motion < self.debounce_time:
+                self.statistics["debounced"] += 1
+                continue
+            self.last_motion = event_time
+            if not self.present:
+                self.transition(True, event_time)
+
+        # Check if presence has timed out
+        if self.present:
+            remaining = self.last_motion + self.hold_time - now
+            if remaining <= 0:
+                if self.level_callback is not None and self.level_callback():
+                    self.logger.debug("Motion sensor still triggered, extending presence")
+                    self.last_motion = now
+                    remaining = self.hold_time
+                else:
+                    self.transition(False, now)
+                    return MAX_WAIT
+            return min(remaining, MAX_WAIT)
+        return MAX_WAIT
+
+    def transition(self, present, when):
+        if present:
+            self.statistics["arrivals"] += 1
+            self.logger.debug("Presence detected")
+        else:
+            self.statistics["departures"] += 1
+            if self.last_change is not None:
+                self.statistics["occupied_seconds"] += when - self.last_change
+            self.logger.debug("Presence timed out")
+        self.present = present
+        self.last_change = when
+        if self.presence_callback is not None:
+            try:
+                self.presence_callback(present)
+            except Exception as e:  # Keep the worker alive if a callback fails
+                self.logger.error(f"Presence callback failed: {e}")
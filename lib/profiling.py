@@ -0,0 +1,99 @@
+# Profiling module
+# A stack sampler for every thread in the program, and a tracer that keeps a record of slow operations
+
+import collections  # Used for counting stacks and keeping the span ring buffer
+import functools  # Used for wrapping traced functions
+import os  # Used for shortening file names in stacks
+import sys  # Used for getting the current stack of every thread
+import threading  # Used for naming threads and stopping two profiles running at once
+import time  # Used for timing samples and spans
+from contextlib import contextmanager  # Used for wrapping traced operations
+
+# Setup constants
+SAMPLE_INTERVAL = 0.005  # Time between stack samples (seconds)
+MAX_PROFILE_SECONDS = 60  # Longest a profile can run for (seconds)
+TRACE_THRESHOLD = 0.5  # Operations taking longer than this are recorded (seconds)
+TRACE_BUFFER_SIZE = 200  # How many slow operations are kept (int)
+
+# Global variables for module
+profile_lock = threading.Lock()
+
+
+# Sample the stack of every thread (Flask, blinds, GPIO callbacks, etc.) for a number of seconds
+# Returns the count of each stack and how many samples were taken
+def sample_stacks(seconds, interval=SAMPLE_INTERVAL):
+    counts = collections.Counter()
+    samples = 0
+    own_thread = threading.get_ident()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_thread:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(thread_names.get(ident, f"thread-{ident}"))
+            counts[";".join(reversed(stack))] += 1
+        samples += 1
+        time.sleep(interval)
+    return counts, samples
+
+
+# Run a profile and return it as collapsed stacks ("thread;outer;...;inner count" per line), which
+# flamegraph.pl and speedscope read directly. Returns None if a profile is already running.
+def profile(seconds):
+    if not profile_lock.acquire(blocking=False):
+        return None
+    try:
+        counts, _ = sample_stacks(min(seconds, MAX_PROFILE_SECONDS))
+    finally:
+        profile_lock.release()
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+# Records any operation slower than the threshold into a ring buffer, so only the latest slow ones are kept
+class Tracer:
+    def __init__(self, threshold=TRACE_THRESHOLD, size=TRACE_BUFFER_SIZE):
+        self.threshold = threshold
+        self.spans = collections.deque(maxlen=size)
+        self.recorded = 0  # How many slow spans have been recorded in total
+
+    @contextmanager
+    def span(self, name, details=None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.finish(name, start, details)
+
+    # Record a span that was started earlier, for operations that don't fit in a with block
+    def finish(self, name, start, details=None):
+        duration = time.monotonic() - start
+        if duration >= self.threshold:
+            self.recorded += 1
+            self.spans.append({"name": name,
+                               "details": details,
+                               "thread": threading.current_thread().name,
+                               "started": time.time() - duration,
+                               "duration": round(duration, 4)})
+
+    # Decorator to trace every call to a function
+    def traced(self, name):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def get_spans(self):
+        return list(self.spans)
+
+
+# The tracer shared by every module
+tracer = Tracer()
@@ -0,0 +1,77 @@
+# Response cache module for the cabin API
+# Holds precomputed JSON bodies for the read endpoints, versioned so clients can skip or wait for changes
+
+import asyncio  # Used for waiting for changes on the event loop in async core mode
+import json  # Used for building the response bodies
+import os  # Used for making a token unique to this run of the program
+import threading  # Used for waking up long polling requests
+
+
+class CachedResponse:
+    def __init__(self, version, body, etag):
+        self.version = version
+        self.body = body
+        self.etag = etag
+
+
+# Bodies are only rebuilt when the state they come from changes, and only get a new version when
+# the body is actually different. The ETag includes a token made at startup so tags from a previous
+# run never match.
+class ResponseCache:
+    def __init__(self):
+        self.token = os.urandom(4).hex()
+        self.entries = {}
+        self.condition = threading.Condition()
+        self.listeners = []  # Called with the endpoint name after every change, from the thread making it
+
+    # Store a new body for an endpoint, returns True if it changed
+    def update(self, name, data):
+        body = json.dumps(data, sort_keys=True).encode()
+        with self.condition:
+            entry = self.entries.get(name)
+            if entry is not None and entry.body == body:
+                return False
+            version = 1 if entry is None else entry.version + 1
+            self.entries[name] = CachedResponse(version, body, f"{self.token}-{version}")
+            self.condition.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(name)
+        return True
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    # Wait until the endpoint has a newer version than since, or the timeout passes
+    def wait_for_change(self, name, since, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: name in self.entries and self.entries[name].version != since,
+                                    timeout)
+            return self.entries.get(name)
+
+    # The same as wait_for_change, but waits on the running event loop instead of holding a thread
+    async def wait_for_change_async(self, name, since, timeout):
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+
+        def listener(changed_name):
+            if changed_name == name and not loop.is_closed():
+                loop.call_soon_threadsafe(changed.set)
+
+        with self.condition:
+            self.listeners.append(listener)
+        try:
+            deadline = loop.time() + timeout
+            while True:
+                changed.clear()
+                entry = self.entries.get(name)
+                remaining = deadline - loop.time()
+                if (entry is not None and entry.version != since) or remaining <= 0:
+                    return entry
+                try:
+                    await asyncio.wait_for(changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.condition:
+                self.listeners.remove(listener)
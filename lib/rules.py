@@ -0,0 +1,111 @@
+# Rule engine module
+# Automation rules declare the signals they depend on, and are only run when one of those signals changes
+
+# Signals are either read from the outside world (sensors, settings, actuator states) or derived from
+# other signals. Every signal is read at most once per tick, and the values are shared by all rules.
+class Signal:
+    def __init__(self, name, read, inputs=()):
+        self.name = name
+        self.read = read  # Called with no arguments for a source, or with the tick's values for a derived signal
+        self.inputs = tuple(inputs)
+
+
+class Rule:
+    def __init__(self, name, inputs, action):
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.action = action  # Called with the tick's values
+
+
+class RuleEngine:
+    def __init__(self, logger):
+        self.logger = logger
+        self.signals = {}
+        self.rules = []
+        self.order = None  # Signals in dependency order, set by compile()
+        self.previous = {}  # Signal values from the last tick
+        self.failed = set()  # Names of rules that raised, run again on every tick until they succeed
+        self.statistics = {"ticks": 0, "signal_reads": 0, "rule_runs": 0, "rule_failures": 0}
+
+    def add_signal(self, name, read, inputs=()):
+        self.signals[name] = Signal(name, read, inputs)
+        self.order = None
+
+    def add_rule(self, name, inputs, action):
+        self.rules.append(Rule(name, inputs, action))
+        self.order = None
+
+    # Put the signals in dependency order, raises ValueError for unknown inputs or loops
+    def compile(self):
+        for item in list(self.signals.values()) + self.rules:
+            for name in item.inputs:
+                if name not in self.signals:
+                    raise ValueError(f"\"{item.name}\" depends on unknown signal \"{name}\"")
+        order = []
+        visiting = set()
+        visited = set()
+
+        def visit(signal):
+            if signal.name in visited:
+                return
+            if signal.name in visiting:
+                raise ValueError(f"Signal \"{signal.name}\" depends on itself")
+            visiting.add(signal.name)
+            for name in signal.inputs:
+                visit(self.signals[name])
+            visiting.discard(signal.name)
+            visited.add(signal.name)
+            order.append(signal)
+
+        for signal in self.signals.values():
+            visit(signal)
+        self.order = order
+        self.logger.debug(f"Compiled {len(self.rules)} rules over {len(order)} signals")
+
+    # Read the signals, then run every rule whose inputs changed since the last tick (all of them on the first tick),
+    # along with any that failed last time
+    # Source signals can be given already read in samples (name to value), for when they were read elsewhere
+    # Returns the names of the rules that ran without failing
+    def tick(self, samples=None):
+        if self.order is None:
+            self.compile()
+        first = not self.previous
+        values = {}
+        changed = set()
+        for signal in self.order:
+            if signal.inputs and not first and not changed.intersection(signal.inputs):
+                values[signal.name] = self.previous[signal.name]  # Inputs unchanged, so no need to derive it again
+                continue
+            if samples is not None and not signal.inputs and signal.name in samples:
+                value = samples[signal.name]
+            else:
+                value = signal.read(values) if signal.inputs else signal.read()
+                self.statistics["signal_reads"] += 1
+            values[signal.name] = value
+            if first or value != self.previous[signal.name]:
+                changed.add(signal.name)
+        self.previous = values
+
+        ran = []
+        for rule in self.rules:
+            if first or changed.intersection(rule.inputs) or rule.name in self.failed:
+                self.logger.debug(f"Running rule {rule.name}")
+                try:
+                    rule.action(values)
+                except Exception as e:  # One broken rule shouldn't stop the others
+                    self.logger.error(f"Rule {rule.name} failed, will try again next tick: {e}")
+                    self.failed.add(rule.name)
+                    self.statistics["rule_failures"] += 1
+                    continue
+                self.failed.discard(rule.name)
+                ran.append(rule.name)
+        self.statistics["ticks"] += 1
+        self.statistics["rule_runs"] += len(ran)
+        return ran
+
+    # Make every rule run on the next tick, for when something outside the signals has changed
+    def reset(self):
+        self.previous = {}
+
+    def get_statistics(self):
+        return dict(self.statistics)
@@ -0,0 +1,99 @@
+# Solar position module
+# Works out a year of sunrise, sunset and when the sun shines on each blind, once at startup,
+# so the blinds can be timed from a table lookup instead of doing the trigonometry every minute
+
+import math  # Used for the solar position equations
+from datetime import timezone  # Used for converting times to UTC
+
+# Setup constants
+DAYS = 366  # One entry per day of the year (the last only used in leap years)
+SAMPLE_MINUTES = 10  # How finely the sun's path is sampled when working out when it reaches each blind
+SUNRISE_ZENITH = math.radians(90.833)  # Zenith at sunrise and sunset, allowing for refraction and the sun's size
+
+
+class SolarDay:
+    __slots__ = ("sunrise", "sunset", "noon", "max_elevation", "sun_on")  # A year of these is kept, so no __dict__ each
+
+    def __init__(self, sunrise, sunset, noon, max_elevation, sun_on):
+        self.sunrise = sunrise  # Minutes after midnight UTC, None if the sun doesn't rise or set that day
+        self.sunset = sunset
+        self.noon = noon
+        self.max_elevation = max_elevation  # Degrees
+        self.sun_on = sun_on  # Blind name to (first, last) minute the sun is in front of it, or None
+
+
+# NOAA general solar position equations, for day of the year (1 - 366) and minutes after midnight UTC
+# Returns the equation of time (minutes) and declination (radians)
+def solar_parameters(day, minutes):
+    fraction = 2 * math.pi / 365 * (day - 1 + (minutes / 60 - 12) / 24)
+    equation_of_time = 229.18 * (0.000075 + 0.001868 * math.cos(fraction) - 0.032077 * math.sin(fraction)
+                                 - 0.014615 * math.cos(2 * fraction) - 0.040849 * math.sin(2 * fraction))
+    declination = (0.006918 - 0.399912 * math.cos(fraction) + 0.070257 * math.sin(fraction)
+                   - 0.006758 * math.cos(2 * fraction) + 0.000907 * math.sin(2 * fraction)
+                   - 0.002697 * math.cos(3 * fraction) + 0.00148 * math.sin(3 * fraction))
+    return equation_of_time, declination
+
+
+# Sun elevation and azimuth (degrees, azimuth clockwise from north) for a day and minutes after midnight UTC
+def sun_position(latitude, longitude, day, minutes):
+    equation_of_time, declination = solar_parameters(day, minutes)
+    hour_angle = math.radians((minutes + equation_of_time + 4 * longitude) / 4 - 180)
+    latitude = math.radians(latitude)
+    cos_zenith = (math.sin(latitude) * math.sin(declination)
+                  + math.cos(latitude) * math.cos(declination) * math.cos(hour_angle))
+    elevation = 90 - math.degrees(math.acos(max(-1.0, min(1.0, cos_zenith))))
+    azimuth = math.degrees(math.atan2(math.sin(hour_angle),
+                                      math.cos(hour_angle) * math.sin(latitude)
+                                      - math.tan(declination) * math.cos(latitude))) + 180
+    return elevation, azimuth % 360
+
+
+def build_day(latitude, longitude, facings, day):
+    equation_of_time, declination = solar_parameters(day, 720)
+    noon = 720 - 4 * longitude - equation_of_time
+    lat = math.radians(latitude)
+    max_elevation = 90 - abs(latitude - math.degrees(declination))
+    cos_hour_angle = (math.cos(SUNRISE_ZENITH) / (math.cos(lat) * math.cos(declination))
+                      - math.tan(lat) * math.tan(declination))
+    if cos_hour_angle > 1:  # Sun never rises
+        return SolarDay(None, None, noon, max_elevation, {name: None for name in facings})
+    if cos_hour_angle < -1:  # Sun never sets
+        sunrise, sunset = None, None
+        start, end = 0, 1440
+    else:
+        hour_angle = math.degrees(math.acos(cos_hour_angle))
+        sunrise = noon - 4 * hour_angle
+        sunset = noon + 4 * hour_angle
+        start, end = sunrise, sunset
+
+    # Sample the sun's path to find when it is in front of each blind (within 90 degrees of the way it faces)
+    sun_on = {name: None for name in facings}
+    minutes = start
+    while minutes <= end:
+        elevation, azimuth = sun_position(latitude, longitude, day, minutes)
+        if elevation > 0:
+            for name, facing in facings.items():
+                if abs((azimuth - facing + 180) % 360 - 180) < 90:
+                    first = sun_on[name][0] if sun_on[name] else minutes
+                    sun_on[name] = (first, minutes)
+        minutes += SAMPLE_MINUTES
+    return SolarDay(sunrise, sunset, noon, max_elevation, sun_on)
+
+
+# A year of solar events for one location, looked up by date
+# Days repeat closely enough from year to year (within a minute or two) that one table covers any year
+class SolarTable:
+    def __init__(self, latitude, longitude, facings):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.facings = dict(facings)  # Blind name to the direction it faces (degrees clockwise from north)
+        self.days = [build_day(latitude, longitude, self.facings, day) for day in range(1, DAYS + 1)]
+
+    def get_day(self, date):
+        return self.days[date.timetuple().tm_yday - 1]
+
+
+# Minutes after midnight UTC for an aware or local datetime, with the UTC date
+def utc_minutes(when):
+    when = when.astimezone(timezone.utc)
+    return when.date(), when.hour * 60 + when.minute + when.second / 60
@@ -0,0 +1,72 @@
+# State store module
+# Saves a snapshot of the cabin state on every change so a restart can carry on where it left off
+
+import json  # Used for reading and writing the snapshot
+import os  # Used for replacing the snapshot file atomically
+import threading  # Used for stopping two threads writing the snapshot at once
+import time  # Used for working out how old the snapshot is
+
+
+# The snapshot is written to a temporary file, flushed to disk and renamed over the old one, so after a
+# crash or power cut the file is always either the old snapshot or the new one, never half written.
+# The file's modification time is touched while the program runs, so its age says how long ago the
+# program last vouched for the state, not just when the state last changed.
+class StateStore:
+    def __init__(self, file_name, logger):
+        self.file_name = file_name
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.last_saved = None
+
+    def load(self):
+        try:
+            with open(self.file_name, "r") as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            self.logger.info("No saved state, starting from scratch")
+            return None
+        except ValueError as e:
+            self.logger.warning(f"Saved state is unreadable, starting from scratch: {e}")
+            return None
+        if not isinstance(state, dict):
+            self.logger.warning("Saved state is unreadable, starting from scratch")
+            return None
+        self.last_saved = json.dumps(state, sort_keys=True)
+        return state
+
+    # How many seconds since the snapshot was last saved or touched, None if there isn't one
+    def get_age(self):
+        try:
+            return time.time() - os.path.getmtime(self.file_name)
+        except OSError:
+            return None
+
+    # Save the state if it has changed since the last save
+    def save(self, state):
+        data = json.dumps(state, sort_keys=True)
+        with self.lock:
+            if data == self.last_saved:
+                return False
+            temp_file_name = self.file_name + ".tmp"
+            with open(temp_file_name, "w") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_file_name, self.file_name)
+
+            # Make sure the rename itself is on disk
+            directory = os.open(os.path.dirname(os.path.abspath(self.file_name)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            self.last_saved = data
+        return True
+
+    # Mark the snapshot as still current without rewriting it
+    def touch(self):
+        with self.lock:
+            try:
+                os.utime(self.file_name)
+            except OSError:
+                pass
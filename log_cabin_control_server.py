@@ -4,11 +4,14 @@
 # Import libraries
 # (Must be installed to Python environment)
 import time  # Used for pausing
-from datetime import datetime  # Used for getting the current date & time
-from flask import Flask, jsonify, request, abort  # Used for receiving REST API calls and sending responses
+from datetime import datetime, timezone  # Used for getting the current date & time
+from flask import Flask, Response, jsonify, request, abort, g  # Used for receiving REST API calls and sending responses
+import itertools  # Used for putting the first chunk of an export back in front of the rest
+import asyncio  # Used for running the control core on one event loop in async core mode
 import logging  # Used for recording program debug output into a file and console
 import threading  # Used for detecting REST API calls alongside running the rest of the program
 import os  # Used for getting the file path of certain directories and checking if a file exists
+import urllib.parse  # Used for reading the long poll version from the query string in async core mode
 from darksky.api import DarkSky  # Used for getting weather data from the Dark Sky API
 from darksky.types import languages, units, weather
 import sqlite3  # Used for accessing the event log database
@@ -20,11 +23,32 @@ from lib import tempsensor  # Used for getting the current temperature from the
 from lib import cabinblinds  # Used for moving the blind servo motors (Supplied by client)
 from lib import energenie  # Used for setting the heater and devices, and getting presence detection from the motion sensor (Supplied by client)
 from lib import lightsensor  # Used for getting light level values from the light sensor (Written by me)
-
+from lib import presence  # Used for debouncing the motion sensor and tracking presence
+from lib import occupancy  # Used for predicting when the cabin will be occupied
+from lib import eventretention  # Used for summarising, archiving and removing old event log rows
+from lib import eventexport  # Used for streaming the event log out as JSON or CSV
+from lib import responsecache  # Used for serving precomputed responses to the read API calls
+from lib import i2cbus  # Used for sharing the I2C bus between the blind servos and the light sensor
+from lib import cabinconfig  # Used for loading the tunable settings and reloading them when they change
+from lib import statestore  # Used for saving the cabin state so a restart can carry on where it left off
+from lib import profiling  # Used for profiling the program and recording slow operations
+from lib import rules  # Used for running the automation rules only when their inputs change
+from lib import solar  # Used for timing the blinds from sunrise, sunset and where the sun is
+from lib import asynccore  # Used for running the control core and the API on one event loop
+from lib import health  # Used for noticing when part of the system stops responding and turning the heating off
+from lib import energy  # Used for adding up how long the heater and devices are on and the energy they use
+
+
+# Low memory profile, set CABIN_LOW_MEMORY=1 for long uptimes on boards with little RAM
+# (Smaller thread stacks, INFO logging and the async core, which replaces the Flask development server and most threads)
+low_memory = os.environ.get("CABIN_LOW_MEMORY") == "1"  # (bool)
+LOW_MEMORY_STACK_SIZE = 256 * 1024  # Stack size of each thread in the low memory profile, in bytes (int)
+if low_memory:
+    threading.stack_size(LOW_MEMORY_STACK_SIZE)  # Must be set before any threads are started
 
 # Set up and start logging
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+logger.setLevel(logging.INFO if low_memory else logging.DEBUG)
 formatter = logging.Formatter(fmt="[%(asctime)s] [%(levelname)s] %(message)s",
                               datefmt="%d/%m/%Y %H:%M:%S")
 
@@ -42,56 +66,121 @@ logger.addHandler(ch)
 
 logger.info("Starting Log Cabin Control System...")
 
+# Load the tunable settings (thresholds, timeouts, time windows, etc.)
+# Each subroutine takes one snapshot of them with "config = CabinConfig.current" so a reload can't change them halfway through
+CONFIG_FILE_NAME = "cabin_config.json"  # The file name of the config file (str)
+CabinConfig = cabinconfig.Config(CONFIG_FILE_NAME, logger)  # The object holding the current settings
+CabinConfig.load()
+ConfigWatcherObject = cabinconfig.ConfigWatcher(CabinConfig, logger)  # The object to reload the settings when the file changes
+
 # Define global variables and constants
 # Main code loop
 cycle_count = 0  # How many main code loops have been performed (int)
-emulation = False
+emulation = os.environ.get("CABIN_SIMULATION") == "1"  # Run without any hardware, set CABIN_SIMULATION=1 (bool)
+tempsensor.emulation_mode = tempsensor.emulation_mode or emulation
+CORE_MODE = os.environ.get("CABIN_CORE", "async" if low_memory else "threads")  # "threads", or "async" to run everything on one event loop (str)
+CoreObject = None  # The object running the event loop's tasks and worker threads in async core mode
+rules_future = None  # The rules tick still running in async core mode, if it overran (asyncio.Future)
+SAMPLED_SIGNALS = {  # Sensor signals read on the event loop with a timeout in async core mode, and the value if that fails
+    "temperature": (lambda: update_temperature(), False),
+    "light_level": (lambda: update_light_level(), None)}
+next_cycle_time = None  # Monotonic time the next main code loop is due (float)
+loop_statistics = {  # How late each main code loop starts and how long it takes, in seconds
+    "cycles": 0,
+    "last_lateness": 0.0,
+    "max_lateness": 0.0,
+    "total_lateness": 0.0,
+    "last_duration": 0.0,
+    "max_duration": 0.0}
 
 # Heating
 auto_heating = False  # If the heating should be automatically changed (bool)
+current_temperature = None  # The last temperature read from the sensor, or False if the sensor had a problem (float)
 heating_mode = "off"  # The heating mode set in the interface (to be depreciated, use auto_heating instead,
 # unless interacting with control interface) (str)
 desired_temp = 20.0  # The desired temperature that should be maintained (float)
 desired_temp_upper = 20.5  # The upper margin of the desired temperature (float)
 desired_temp_lower = 19.5  # The lower margin of the desired temperature (float)
-DESIRED_TEMP_UPPER_BOUND = 30  # The upper bound of the desired temperature (int)
-DESIRED_TEMP_LOWER_BOUND = 15  # The lower bound of the desired temperature (int)
-DESIRED_TEMP_INCREMENT = 0.5  # How much to increment or decrement the desired temperature by (float)
-DESIRED_TEMP_MARGIN = 0.5  # How much to deviate the desired temperature by when checking the actual temperature (float)
+auto_preheat = False  # If the heating should be turned down while the cabin is empty and up before an expected arrival (bool)
 HeaterObject = energenie.device(socket_number=1, logger=logger)  # The object to control the heater
 
 # Devices
 auto_presence = True  # If the devices should be automatically turned on (bool)
-PRESENCE_TIMEOUT = 30
+OCCUPANCY_MODEL_FILE_NAME = "occupancy_model.bin"  # The file name of the saved occupancy model (str)
+OccupancyObject = occupancy.OccupancyModel(logger=logger)  # The object to predict occupancy
 DevicesObject = energenie.device(socket_number=2, logger=logger)  # The object to control the devices
 CABIN_PIR = 19    # The GPIO pin of the motion sensor (physical pin 35) (int)
-MotionSensorObject = energenie.GPIOInputDevice(CABIN_PIR)
+MotionSensorObject = energenie.GPIOInputDevice(CABIN_PIR, simulation=emulation)
+
+# The object to debounce the motion sensor and track presence (presence_changed is defined below)
+PresenceObject = presence.PresenceMonitor(logger=logger,
+                                          presence_callback=lambda present: presence_changed(present),
+                                          level_callback=MotionSensorObject.get_state,
+                                          debounce_time=CabinConfig.current["presence_debounce"],
+                                          hold_time=CabinConfig.current["presence_timeout"] * 60)
 
 # Blinds
 auto_blinds = True  # If the blinds should be automatically be open and closed (bool)
-CLOUD_COVER_THRESHOLD = 0.5  # The threshold of the percentage cloud cover (float)
-TEMPERATURE_THRESHOLD = 20  # The threshold of the maximum temperature of the day (int)
-LIGHT_LEVEL_THRESHOLD = 1200000  # The threshold of the light level outside (float)
 CABIN_LOCATION = {"LATITUDE": 51.456857, "LONGITUDE": -1.053791}  # The location of the cabin (dict{float})
-LightSensorObject = lightsensor.LightSensor(logger=logger, gain="low")  # The object to receive data from the light sensor
+SolarTableObject = None  # The object holding a year of sunrise, sunset and sun on blind times (built below)
+daily_forecast = {"date": None, "cloud_cover": None, "temperature": None}  # Today's forecast, only fetched once a day
+LightSensorObject = lightsensor.LightSensor(logger=logger, gain=CabinConfig.current["light_sensor_gain"])  # The object to receive data from the light sensor
 
 
+BLIND_CALIBRATION_FILE_NAME = "blind_calibration.json"  # The file name of the blind calibration tables (str)
+BLIND_MOVE_TIMEOUT = 60  # The longest to wait for a blind to finish moving, in seconds (int)
+blind_calibrations = cabinblinds.load_calibrations(BLIND_CALIBRATION_FILE_NAME, logger)  # Calibration tables for each blind
 blind_objects = {  # List of objects to control the blinds
-    "left": cabinblinds.blindservo("left", 0, logger, simulation=emulation),
-    "leftdoor": cabinblinds.blindservo("leftdoor", 1, logger, simulation=emulation),
-    "rightdoor": cabinblinds.blindservo("rightdoor", 2, logger, simulation=emulation),
-    "right": cabinblinds.blindservo("right", 3, logger, simulation=emulation)}
+    "left": cabinblinds.blindservo("left", 0, logger, simulation=emulation,
+                                   calibration=blind_calibrations.get("left")),
+    "leftdoor": cabinblinds.blindservo("leftdoor", 1, logger, simulation=emulation,
+                                       calibration=blind_calibrations.get("leftdoor")),
+    "rightdoor": cabinblinds.blindservo("rightdoor", 2, logger, simulation=emulation,
+                                        calibration=blind_calibrations.get("rightdoor")),
+    "right": cabinblinds.blindservo("right", 3, logger, simulation=emulation,
+                                    calibration=blind_calibrations.get("right"))}
+BlindServiceObject = cabinblinds.BlindService(blind_objects.values(), logger)  # The thread to step the blinds in thread core mode
+
+# Watchdog
+# (Components send heartbeats or are timed while they run, the heating is turned off if the main code loop
+# or the temperature sensor stops working)
+WATCHDOG_MISSED_CYCLES = 3  # How many main code loops can be missed before the main code loop is stale (int)
+RADIO_TIMEOUT = 30  # The longest a radio transmit should take, in seconds (int)
+WatchdogObject = health.watchdog  # The object to check each component is still working
+WatchdogObject.setup(logger)
 
 # Miscellaneous
 app = Flask(__name__)  # Flask app initialisation
+ResponseCacheObject = responsecache.ResponseCache()  # The object to hold the read API call responses
+LONG_POLL_PATHS = {"/cabinapi/getheating": "heating", "/cabinapi/getblinds": "blinds"}  # Read API calls that can long poll, and their cached response (dict{str})
 BIND = "0.0.0.0"
 PORT = 7890
 app_thread = threading.Thread(target=app.run, kwargs={"host":BIND,"port":PORT}, name="cabinapi", daemon=True)  # Flask app thread
 use_darksky_api = False  # If Dark Sky API functions should be used or not (bool)
 DARKSKY_API_KEY_FILE_NAME = "darksky_api_key.txt"  # The file name of the Dark Sky API key file (str)
 API_KEY = ""  # The secret key used to access the Dark Sky API, obtained from the above file (str)
+darksky_client = None  # The Dark Sky API client, made the first time it is needed and then reused
 use_database = False  # If event log database functions should be used or not (bool)
 DATABASE_FILE_NAME = "event_log.db"  # The file name of the event log database (str)
+event_connection = None  # The event log database connection kept open for writing events
+event_connection_lock = threading.Lock()  # Stops two threads writing events on the connection at once
+EXTRA_TRIGGERS = [  # Trigger codes added since the database was first made, added to it at startup (list[tuple])
+    ("WDOGSTL", "Watchdog Stale Component", "When the watchdog finds part of the system has stopped responding.",
+     "The part of the system that stopped responding.")]
+STATE_FILE_NAME = "cabin_state.json"  # The file name of the saved state (str)
+StateStoreObject = statestore.StateStore(STATE_FILE_NAME, logger)  # The object to save and restore the cabin state
+state_restored = False  # If the saved state has been restored yet, nothing is saved until it has (bool)
+ARCHIVE_EVENTS = True  # If summarised rows should be archived to compressed monthly files rather than just deleted (bool)
+RetentionObject = eventretention.EventRetention(DATABASE_FILE_NAME, logger, retention_days=CabinConfig.current["event_retention_days"],
+                                                archive=ARCHIVE_EVENTS)  # The object to run the retention job
+
+# Energy
+EnergyObject = energy.EnergyMeter(DATABASE_FILE_NAME, logger)  # The object to add up the heater and devices energy use
+EnergyObject.add_socket("heater", CabinConfig.current["heater_watts"])
+EnergyObject.add_socket("devices", CabinConfig.current["devices_watts"])
+HeaterObject.add_listener(lambda state: EnergyObject.set_state("heater", state))
+DevicesObject.add_listener(lambda state: EnergyObject.set_state("devices", state))
+
 # The following are keyword constants to improve readability of the code
 ON = True
 OFF = False
@@ -102,54 +191,294 @@ CLOSED = 20
 # Define subroutines
 # Main code loop
 def main_loop():
+    # Wait until the next loop is due (1 minute by default)
+    time.sleep(run_cycle())
+
+
+# Main code loop cycle subroutine
+# (One main code loop without the wait, returns how long to wait until the next one is due)
+def run_cycle():
+    cycle_start = start_cycle()
+
+    # Run the automation rules whose inputs have changed (traced as one span so slow cycles are recorded)
+    with profiling.tracer.span("main_loop", f"cycle {cycle_count}"):
+        ran = RulesObject.tick()
+        WatchdogObject.heartbeat("scheduler")  # Only once the rules have actually run
+        logger.debug(f"Rules run: {', '.join(ran) if ran else 'none'}")
+
+        # Mark the saved state as still current, and write the energy totals every so often
+        StateStoreObject.touch()
+        EnergyObject.flush_if_due()
+
+    return finish_cycle(cycle_start)
+
+
+# Async main code loop
+# (Same as the main code loop, but the sensors are read on the event loop with a timeout and the rules
+# run in the control thread, so a stuck sensor or a long blind move never holds up the servos or the API)
+async def async_main_loop():
     # Get global variable
-    global cycle_count
+    global rules_future
 
-    # Execute subroutines
-    logger.debug("Running heating module")
-    heating()  # Heating Module
-    logger.debug("Running devices module")
-    devices()  # Devices Module
-    logger.debug("Running blinds module")
-    blinds()   # Blinds Module
+    cycle_start = start_cycle()
+    with profiling.tracer.span("main_loop", f"cycle {cycle_count}"):
+        if rules_future is not None and not rules_future.done():
+            logger.warning("Rules from the last cycle still running, skipping")
+        else:
+            # Read the sensors at the same time
+            names = list(SAMPLED_SIGNALS)
+            values = await asyncio.gather(*(CoreObject.call(SAMPLED_SIGNALS[name][0], default=SAMPLED_SIGNALS[name][1],
+                                                            name=name) for name in names))
+            samples = dict(zip(names, values))
+
+            # Run the automation rules, waiting at most one loop interval for them
+            rules_future = asyncio.ensure_future(CoreObject.run(RulesObject.tick, samples))
+            rules_future.add_done_callback(rules_finished)
+            try:
+                ran = await asyncio.wait_for(asyncio.shield(rules_future), CabinConfig.current["loop_interval"])
+                logger.debug(f"Rules run: {', '.join(ran) if ran else 'none'}")
+            except asyncio.TimeoutError:
+                logger.warning("Rules still running at the end of the cycle")
+        await CoreObject.call(StateStoreObject.touch)
+        await CoreObject.call(EnergyObject.flush_if_due)
+
+    await asyncio.sleep(finish_cycle(cycle_start))
+
+
+# Config file callback for the async main code loop
+# (Only reads the change events on the event loop, the reload runs in the control thread as applying it can use the
+# hardware and rebuild the solar table)
+def config_file_changed():
+    if ConfigWatcherObject.read_events():
+        logger.debug("Config file changed, reloading")
+        asyncio.ensure_future(CoreObject.run(CabinConfig.load))
+
+
+# Rules finished callback for the async main code loop
+# (The scheduler heartbeat is only sent once a rules tick has returned, so a stuck tick goes stale even though the
+# cycles carry on skipping it)
+def rules_finished(future):
+    if not future.cancelled() and future.exception() is None:
+        WatchdogObject.heartbeat("scheduler")
+
+
+# Start of main code loop subroutine
+# (Records how late this loop started (control loop jitter), returns the start time)
+def start_cycle():
+    cycle_start = time.monotonic()
+    if next_cycle_time is not None:
+        lateness = max(0.0, cycle_start - next_cycle_time)
+        loop_statistics["last_lateness"] = lateness
+        loop_statistics["max_lateness"] = max(loop_statistics["max_lateness"], lateness)
+        loop_statistics["total_lateness"] += lateness
+    return cycle_start
+
+
+# End of main code loop subroutine
+# (Records how long this loop took, returns how long to wait until the next loop is due)
+def finish_cycle(cycle_start):
+    # Get global variables
+    global cycle_count, next_cycle_time
+
+    duration = time.monotonic() - cycle_start
+    loop_statistics["cycles"] += 1
+    loop_statistics["last_duration"] = duration
+    loop_statistics["max_duration"] = max(loop_statistics["max_duration"], duration)
 
-    # Increase cycle count and wait
+    # Increase cycle count
     cycle_count += 1  # Increase cycle count by one
     logger.debug(f"Cycle count is now {cycle_count}")
-    logger.debug("Waiting 1 minute")
-    time.sleep(60)  # Wait 1 minute
+    interval = CabinConfig.current["loop_interval"]
+    next_cycle_time = cycle_start + interval
+    logger.debug(f"Waiting {interval} seconds")
+    return max(0.0, next_cycle_time - time.monotonic())
 
 
-# Heating subroutine
-def heating():
-    # Get global variables
-    global auto_heating, desired_temp_upper, desired_temp_lower
+# Temperature update subroutine
+def update_temperature():
+    # Get global variable
+    global current_temperature
+
+    current_temperature = tempsensor.get_temperature()
+    if current_temperature is False:  # In case there was a problem with the sensor (0.0 is a real reading)
+        logger.warning("Problem getting current temperature from sensor")
+    else:
+        WatchdogObject.heartbeat("temperature")
+    publish_heating()
+    return current_temperature
+
+
+# Light level update subroutine
+def update_light_level():
+    light_level = LightSensorObject.get_measurement("full_spectrum")
+    WatchdogObject.heartbeat("light_sensor")
+    return light_level
+
+
+# Heater fail-safe subroutine
+# (Run by the watchdog when the main code loop or the temperature sensor stops working, so the heater
+# can't be left on with nothing checking the temperature)
+def heater_fail_safe(component):
+    if HeaterObject.get_state() is ON:
+        logger.warning(f"Turning heating off as {component} has stopped responding")
+        HeaterObject.switch(OFF)
+        publish_heating()
+        write_event("WDOGSTL", component, "HEATSTA", "off", True)
+
+
+# Watchdog setup subroutine
+def setup_watchdog():
+    config = CabinConfig.current
+    WatchdogObject.register("scheduler", config["loop_interval"] * WATCHDOG_MISSED_CYCLES, heater_fail_safe)
+    WatchdogObject.register("temperature", config["watchdog_sensor_timeout"] * 60, heater_fail_safe)
+    WatchdogObject.register("light_sensor", config["watchdog_sensor_timeout"] * 60)
+    WatchdogObject.register("radio", RADIO_TIMEOUT, operation=True)
+
 
+# Occupancy subroutine
+def occupancy_update(values):
+    # Fold any finished hours into the occupancy model
+    OccupancyObject.update()
+
+    # Adjust the presence timeout to how likely the cabin is to be occupied this hour
+    config = values["config"]
+    timeout = OccupancyObject.get_timeout(config["presence_timeout"], config["presence_timeout_min"],
+                                          config["presence_timeout_max"])
+    logger.debug(f"Presence timeout: {timeout:.1f} minutes")
+    PresenceObject.set_hold_time(timeout * 60)
+
+    # Save the model so it survives a restart
+    save_occupancy_model()
+
+
+# Save occupancy model subroutine
+def save_occupancy_model():
+    try:
+        OccupancyObject.save(OCCUPANCY_MODEL_FILE_NAME)
+    except OSError as e:
+        logger.error(f"Could not save occupancy model: {e}")
+
+
+# Load occupancy model subroutine
+# (Rebuilds the model from the presence events in the event log if it hasn't been saved before)
+def load_occupancy_model():
+    if OccupancyObject.load(OCCUPANCY_MODEL_FILE_NAME) or not use_database:
+        return
+    logger.debug("Rebuilding occupancy model from event log")
+    conn = connect_database(DATABASE_FILE_NAME)
+    if conn is None:
+        return
+    when = None
+    try:
+        rows = conn.execute("SELECT Timestamp, TriggerCode FROM EventLog WHERE TriggerCode IN ('PRESDEC', 'PRESTMO') "
+                            "ORDER BY EventID")
+        for timestamp, trigger_code in rows:
+            # Timestamps in the event log are in UTC, the model works in local time
+            when = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+            when = when.astimezone().replace(tzinfo=None)
+            OccupancyObject.record(trigger_code == "PRESDEC", when)
+    except Error as e:
+        logger.error(f"Could not rebuild the occupancy model from the event log: {e}")
+    finally:
+        conn.close()
+    if when is not None:
+        OccupancyObject.record(False, when)  # Don't count the time the program wasn't running as occupied
+        save_occupancy_model()
+
+
+# Heating margins signal
+# (Turns the desired temperature down while the cabin is empty and no arrival is expected)
+def get_heating_margins(values):
+    config = values["config"]
+    lower, upper = values["desired_temp"]
+    if values["auto_preheat"] and not values["present"] and not values["arrival_expected"]:
+        logger.debug("Cabin empty and no arrival expected, using setback temperature")
+        return lower - config["setback_temp"], upper - config["setback_temp"]
+    return lower, upper
+
+
+# Arrival expected signal
+def get_arrival_expected():
+    # Only needed for pre-heating, so don't bother otherwise
+    if not auto_preheat:
+        return False
+    config = CabinConfig.current
+    return OccupancyObject.arrival_expected(config["preheat_hours"], config["preheat_threshold"])
+
+
+# Blind period signal
+# (Which blinds check, if any, should be running now. Follows sunrise and sunset from the solar table
+# if solar timing is on, otherwise uses the fixed hours.)
+def get_blind_period(values):
+    config = values["config"]
+    solar_day = values["solar_day"]
+    if config["solar_timing"] and solar_day.sunrise is not None:
+        current_minutes = values["utc_time"][1]
+        morning_start = solar_day.sunrise + config["blinds_morning_offset"]
+        evening_start = solar_day.sunset + config["blinds_evening_offset"]
+        if in_solar_window(current_minutes, morning_start, config["blinds_morning_duration"]):
+            return "morning"
+        elif in_solar_window(current_minutes, evening_start, config["blinds_evening_duration"]):
+            return "evening"
+        return None
+
+    current_hour = values["hour"]
+    if config["blinds_morning_start"] <= current_hour < config["blinds_morning_end"]:  # 7 - 8 AM in the morning
+        return "morning"
+    elif config["blinds_evening_start"] <= current_hour < config["blinds_evening_end"]:  # 5 - 10 PM in the evening
+        return "evening"
+    return None
+
+
+# Solar window subroutine
+# (The times are UTC minutes of the day, so an offset window can start before midnight or run past it, compared
+# modulo a day so it still matches either side of midnight)
+def in_solar_window(current_minutes, start, duration):
+    return (current_minutes - start) % 1440 < duration
+
+
+# Solar table subroutine
+# (Builds a year of solar events for the cabin and the way each blind faces, only needed at startup
+# and when a blind's direction changes)
+def build_solar_table():
+    # Get global variable
+    global SolarTableObject
+
+    config = CabinConfig.current
+    facings = {}
+    for current_blind in blind_objects:
+        facings[current_blind] = config[f"blind_{current_blind}_facing"]
+    logger.debug("Building solar table")
+    SolarTableObject = solar.SolarTable(CABIN_LOCATION["LATITUDE"], CABIN_LOCATION["LONGITUDE"], facings)
+
+
+# Heating subroutine
+def heating(values):
     # Only run this if heating is set to auto
-    if auto_heating:
+    if values["auto_heating"]:
         logger.debug("Auto heating is true, running")
 
-        # Obtain current temperature
-        logger.debug("Getting temperature")
-        temp = tempsensor.get_temperature()
-        if not temp:  # In case there was a problem with the sensor
-            logger.warning("Problem getting current temperature from sensor")
-            logger.debug("Skipping...")
+        # Use the temperature read for this tick
+        current_temperature = values["temperature"]
+        if current_temperature is False:  # In case there was a problem with the sensor (0.0 is a real reading)
+            logger.debug("No current temperature, skipping...")
         else:
-            current_temperature = temp
             logger.debug(f"Current temperature: {current_temperature}")
             logger.debug(f"Desired temperature: {desired_temp}")
 
             # Choose action to perform
-            state = HeaterObject.get_state()
+            desired_temp_lower, desired_temp_upper = values["heating_margins"]
+            state = values["heater_state"]
             logger.debug(f"Heating state: {state}")
             if state is ON and current_temperature > desired_temp_upper:
                 logger.debug("Turning heating off")  # Turn the heating off
                 HeaterObject.switch(OFF)
+                publish_heating()
                 write_event("TEMPABV", str(current_temperature), "HEATSTA", "off", True)
             elif state is OFF and current_temperature < desired_temp_lower:
                 logger.debug("Turning heating on")  # Turn the heating on
                 HeaterObject.switch(ON)
+                publish_heating()
                 write_event("TEMPBEL", str(current_temperature), "HEATSTA", "on", True)
             else:
                 logger.debug("No action needed, skipping")  # Won't need to turn on or off now
@@ -159,26 +488,18 @@ def heating():
 
 
 # Devices subroutine
-def devices():
-    # Get global variables
-    global auto_presence, cycle_count
-
+def devices(values):
     # Only run this if presence is set to auto
-    if auto_presence:
+    if values["auto_presence"]:
         logger.debug("Auto presence is true, running")
 
         # See if devices should be turned off
-        if DevicesObject.get_state():
-            if MotionSensorObject.get_state():
-                logger.debug("Motion sensor still triggered")
-                logger.debug("Resetting cycle count back to 0")
-                cycle_count = 0  # Reset cycle count
-            elif cycle_count >= PRESENCE_TIMEOUT:
+        if values["devices_state"]:
+            if not values["present"]:
                 logger.debug("Turning off devices")  # Turn the devices off
                 DevicesObject.switch(OFF)
+                save_state()
                 write_event("PRESTMO", None, "DEVISTA", "off", True)
-                logger.debug("Resetting cycle count back to 0")
-                cycle_count = 0  # Reset cycle count
             else:
                 logger.debug("No action needed, skipping")  # Won't need to turn off now
         else:
@@ -188,79 +509,90 @@ def devices():
         logger.debug("Auto presence is false, skipping")
 
 
-# Blinds subroutine
-def blinds():
-    # Get global variable
-    global auto_blinds
-    
-    # Obtain current light level
-    logger.debug("Getting light level")
-    light_level = LightSensorObject.get_measurement("full_spectrum")
-    logger.debug(f"Light level: {light_level} (full spectrum)")
-
-    # Only run this if blinds are set to auto
-    if auto_blinds:
-        logger.debug("Auto blinds is true, running")
-
-        # Obtain current time right now
-        current_datetime = datetime.now()
-        current_hour = current_datetime.hour
-        logger.debug(f"Current date & time: {current_datetime}")
-        logger.debug(f"Current hour: {current_hour}")
-        
-        # Perform an extra subroutine
-        state_average = get_blind_state_average()
-        logger.debug(f"Average state of blinds: {state_average}")
-        if 7 <= current_hour < 8 and state_average < 15.5:  # 7 - 8 AM in the morning & blinds open
-            logger.debug("Running blinds morning subroutine")
-            blinds_morning()  # Will close blinds if successful
-        elif 17 <= current_hour < 22 and state_average > 14.5:  # 5 - 10 PM in the evening & blinds closed
-            logger.debug("Running blinds evening subroutine")
-            blinds_evening()  # Will open blinds if successful
-        else:
-            logger.debug("No action needed, skipping")  # Won't need to run a subroutine right now
-
-    else:
-        logger.debug("Auto blinds is false, skipping")
-
-
 # Blinds morning subroutine
-def blinds_morning():
+def blinds_morning(values):
     # Get global variables
-    global CLOUD_COVER_THRESHOLD, TEMPERATURE_THRESHOLD, CABIN_LOCATION, API_KEY
+    global CABIN_LOCATION, API_KEY
+    config = values["config"]
+
+    # Only run this if blinds are set to auto, it is the morning and the blinds are open
+    if not values["auto_blinds"]:
+        logger.debug("Auto blinds is false, skipping")
+        return
+    if values["blind_period"] != "morning" or values["blind_average"] >= 15.5:
+        logger.debug("No action needed, skipping")  # Won't need to run right now
+        return
+
+    # With solar timing, only the blinds the sun reaches today need closing, and if the sun stays low
+    # all day it won't get hot enough to matter, so there's no need to get the forecast at all
+    selected_blinds = list(blind_objects)
+    if config["solar_timing"]:
+        solar_day = values["solar_day"]
+        if solar_day.max_elevation < config["solar_min_elevation"]:
+            logger.debug(f"Sun only reaches {solar_day.max_elevation:.1f} degrees today, skipping")
+            return
+        selected_blinds = [current_blind for current_blind in blind_objects
+                           if solar_day.sun_on[current_blind] is not None
+                           and blind_objects[current_blind].state != CLOSED]
+        if not selected_blinds:
+            logger.debug("Sun doesn't reach any open blinds today, skipping")
+            return
 
     # Obtain forecast, specifically cloud cover and temperature max values
     if use_darksky_api:
-        logger.debug("Getting forecast")
-        forecast = weather_data(CABIN_LOCATION["LATITUDE"], CABIN_LOCATION["LONGITUDE"], API_KEY)
-        cloud_cover = forecast.daily.data[0].cloud_cover
-        temperature = forecast.daily.data[0].temperature_high
+        cloud_cover, temperature = get_daily_forecast()
         logger.debug(f"Cloud cover: {cloud_cover}")
         logger.debug(f"Temperature: {temperature}")
 
         # Check to see if it exceeds the thresholds
-        if cloud_cover < CLOUD_COVER_THRESHOLD and temperature > TEMPERATURE_THRESHOLD:
-            logger.debug("Closing blinds")  # Close all the blinds
-            set_all_blinds(CLOSED)
-            write_event("BLNDMOR", f"{cloud_cover}, {temperature}", "BLNDSTA", "all, 20", True)
+        if cloud_cover < config["cloud_cover_threshold"] and temperature > config["temperature_threshold"]:
+            if len(selected_blinds) == len(blind_objects):
+                logger.debug("Closing blinds")  # Close all the blinds
+                set_all_blinds(CLOSED)
+                write_event("BLNDMOR", f"{cloud_cover}, {temperature}", "BLNDSTA", "all, 20", True)
+            else:
+                for current_blind in selected_blinds:
+                    logger.debug(f"Closing blind {current_blind}")  # Close the blinds the sun will reach
+                    set_blind(current_blind, CLOSED)
+                    write_event("BLNDMOR", f"{cloud_cover}, {temperature}", "BLNDSTA", f"{current_blind}, 20", True)
         else:
             logger.debug("No action needed, skipping")  # Don't need to open them today
     else:
         logger.debug("Dark Sky API unavailable, skipping")
 
 
-# Blinds evening subroutine
-def blinds_evening():
-    # Get global variable
-    global LIGHT_LEVEL_THRESHOLD
+# Daily forecast subroutine
+# (Only asks Dark Sky once a day, then reuses the answer)
+def get_daily_forecast():
+    today = datetime.now().date()
+    if daily_forecast["date"] != today:
+        logger.debug("Getting forecast")
+        forecast = weather_data(CABIN_LOCATION["LATITUDE"], CABIN_LOCATION["LONGITUDE"], API_KEY)
+        daily_forecast["cloud_cover"] = forecast.daily.data[0].cloud_cover
+        daily_forecast["temperature"] = forecast.daily.data[0].temperature_high
+        daily_forecast["date"] = today
+    return daily_forecast["cloud_cover"], daily_forecast["temperature"]
 
-    # Obtain current light level
-    logger.debug("Getting light level")
-    light_level = LightSensorObject.get_measurement("full_spectrum")
+
+# Blinds evening subroutine
+def blinds_evening(values):
+    # Only run this if blinds are set to auto, it is the evening and the blinds are closed
+    if not values["auto_blinds"]:
+        logger.debug("Auto blinds is false, skipping")
+        return
+    if values["blind_period"] != "evening" or values["blind_average"] <= 14.5:
+        logger.debug("No action needed, skipping")  # Won't need to run right now
+        return
+
+    # Use the light level read for this tick
+    light_level = values["light_level"]
+    if light_level is None:  # In case there was a problem with the sensor, so a fault never opens the blinds
+        logger.warning("No light level from sensor, skipping")
+        return
     logger.debug(f"Light level: {light_level} (full spectrum)")
 
     # Check to see if it exceeds the threshold
-    if light_level < LIGHT_LEVEL_THRESHOLD:
+    if light_level < values["config"]["light_level_threshold"]:
         logger.debug("Opening blinds")  # Open all the blinds
         set_all_blinds(OPEN)
         write_event("BLNDEVE", str(light_level), "BLNDSTA", "all, 10", True)
@@ -268,52 +600,120 @@ def blinds_evening():
         logger.debug("No action needed, skipping")  # Don't need to close them tonight
 
 
-# Desired temp change subroutine
-def desired_temp_change():
-    # Get global variables
-    global desired_temp, desired_temp_upper, desired_temp_lower, DESIRED_TEMP_MARGIN
-
-    desired_temp_upper = desired_temp + DESIRED_TEMP_MARGIN  # Set desired temp upper
-    desired_temp_lower = desired_temp - DESIRED_TEMP_MARGIN  # Set desired temp lower
+# Automation rules
+# Each signal is read once per tick and shared, and each rule only runs when one of its inputs has changed
+# (so adding a rule doesn't add sensor reads). Signals: name, read function, [inputs if derived from other signals]
+RulesObject = rules.RuleEngine(logger)  # The object to run the automation rules
+RulesObject.add_signal("config", lambda: CabinConfig.current)
+RulesObject.add_signal("hour", lambda: datetime.now().hour)
+RulesObject.add_signal("utc_time", lambda: solar.utc_minutes(datetime.now().astimezone()))
+RulesObject.add_signal("temperature", lambda: update_temperature())
+RulesObject.add_signal("light_level", lambda: update_light_level())
+RulesObject.add_signal("present", lambda: PresenceObject.is_present())
+RulesObject.add_signal("arrival_expected", get_arrival_expected)
+RulesObject.add_signal("auto_heating", lambda: auto_heating)
+RulesObject.add_signal("auto_preheat", lambda: auto_preheat)
+RulesObject.add_signal("auto_presence", lambda: auto_presence)
+RulesObject.add_signal("auto_blinds", lambda: auto_blinds)
+RulesObject.add_signal("desired_temp", lambda: (desired_temp_lower, desired_temp_upper))
+RulesObject.add_signal("heater_state", lambda: HeaterObject.get_state())
+RulesObject.add_signal("devices_state", lambda: DevicesObject.get_state())
+RulesObject.add_signal("blind_average", lambda: get_blind_state_average())
+RulesObject.add_signal("heating_margins", get_heating_margins,
+                       ["config", "desired_temp", "auto_preheat", "present", "arrival_expected"])
+RulesObject.add_signal("solar_day", lambda values: SolarTableObject.get_day(values["utc_time"][0]),
+                       ["utc_time"])  # Same object all day, so only changes at midnight UTC
+RulesObject.add_signal("blind_period", get_blind_period, ["config", "hour", "utc_time", "solar_day"])
+RulesObject.add_rule("occupancy", ["config", "hour"], occupancy_update)
+RulesObject.add_rule("heating", ["auto_heating", "temperature", "heating_margins", "heater_state"], heating)
+RulesObject.add_rule("devices", ["auto_presence", "present", "devices_state"], devices)
+RulesObject.add_rule("blinds_morning", ["auto_blinds", "blind_period", "blind_average", "config", "solar_day"],
+                     blinds_morning)
+RulesObject.add_rule("blinds_evening", ["auto_blinds", "blind_period", "blind_average", "light_level", "config"],
+                     blinds_evening)
+RulesObject.compile()
 
 
-# Presence interrupt subroutine
-def presence_interrupt(pin):
+# Desired temp change subroutine
+def desired_temp_change():
     # Get global variables
-    global auto_presence, cycle_count
-    logger.debug(f"Presence detected by motion sensor on pin {pin}")
-
-    # Only run this if presence is set to auto
-    if auto_presence:
-
-        # See if devices should be turned on
-        if not DevicesObject.get_state():
-            logger.debug("Turning on devices")  # Turn the devices on
-            DevicesObject.switch(ON)
-            write_event("PRESDEC", None, "DEVISTA", "on", True)
+    global desired_temp, desired_temp_upper, desired_temp_lower
+
+    margin = CabinConfig.current["desired_temp_margin"]
+    desired_temp_upper = desired_temp + margin  # Set desired temp upper
+    desired_temp_lower = desired_temp - margin  # Set desired temp lower
+
+
+# Config change subroutine
+# (Runs whenever new settings are applied, pushes settings held by other objects out to them)
+def config_changed(old, new):
+    if new["light_sensor_gain"] != old["light_sensor_gain"]:
+        LightSensorObject.set_gain(new["light_sensor_gain"])
+    if new["desired_temp_margin"] != old["desired_temp_margin"]:
+        desired_temp_change()
+        publish_heating()
+    PresenceObject.set_debounce_time(new["presence_debounce"])
+    for current_blind in blind_objects:
+        if new[f"blind_{current_blind}_facing"] != old[f"blind_{current_blind}_facing"]:
+            build_solar_table()
+            break
+    profiling.tracer.threshold = new["trace_threshold"] / 1000
+    RetentionObject.retention_days = new["event_retention_days"]
+    WatchdogObject.set_max_age("scheduler", new["loop_interval"] * WATCHDOG_MISSED_CYCLES)
+    WatchdogObject.set_max_age("temperature", new["watchdog_sensor_timeout"] * 60)
+    WatchdogObject.set_max_age("light_sensor", new["watchdog_sensor_timeout"] * 60)
+    EnergyObject.set_watts("heater", new["heater_watts"])
+    EnergyObject.set_watts("devices", new["devices_watts"])
+    # Presence timeouts are picked up by the occupancy subroutine and everything else is read when it is used
+
+
+CabinConfig.add_listener(config_changed)
+build_solar_table()
+setup_watchdog()
+profiling.tracer.threshold = CabinConfig.current["trace_threshold"] / 1000
+
+
+# Presence change subroutine
+# (Runs in the presence monitor thread once per debounced transition, never in the interrupt itself)
+def presence_changed(present):
+    # Get global variable
+    global auto_presence
+
+    # Record the transition for occupancy prediction
+    OccupancyObject.record(present)
+
+    # Only turn devices on here, the devices subroutine turns them off once presence times out
+    if present:
+        # Only run this if presence is set to auto
+        if auto_presence:
+
+            # See if devices should be turned on
+            if not DevicesObject.get_state():
+                logger.debug("Turning on devices")  # Turn the devices on
+                DevicesObject.switch(ON)
+                save_state()
+                write_event("PRESDEC", None, "DEVISTA", "on", True)
+            else:
+                logger.debug("No action needed, skipping")  # Won't need to turn on now
         else:
-            logger.debug("No action needed, skipping")  # Won't need to turn on now
-        logger.debug("Resetting cycle count back to 0")
-        cycle_count = 0  # Reset cycle count
-    else:
-        logger.debug("Auto presence is false, skipping")
+            logger.debug("Auto presence is false, skipping")
 
 
 # Set state of singular blind subroutine
+@profiling.tracer.traced("set_blind")
 def set_blind(selected_blind, state):
-    temp = 0
-    # Make sure all blinds are not active.
+    # Make sure all blinds are not active, so only one servo moves at a time.
     logger.debug("Waiting for blinds to finish")
     for check_blind in blind_objects:
-        while blind_objects[check_blind].active:
-            temp += 1  # Wait if a blind is active.
-            time.sleep(1)
+        if not blind_objects[check_blind].wait_until_idle(BLIND_MOVE_TIMEOUT):
+            logger.warning(f"Blind {check_blind} still moving after {BLIND_MOVE_TIMEOUT} seconds")
     logger.debug(f"Setting blind {selected_blind} to position {state}")
     blind_objects[selected_blind].set_state(state)
-    while blind_objects[selected_blind].active:
-        temp += 1  # Wait while blind is being set.
-        time.sleep(1)
-    return temp
+    publish_blinds()
+    # Wait while blind is being set (only as long as the move needs), then save the position it has reached
+    if not blind_objects[selected_blind].wait_until_idle(BLIND_MOVE_TIMEOUT):
+        logger.warning(f"Blind {selected_blind} still moving after {BLIND_MOVE_TIMEOUT} seconds")
+    save_state()
 
 
 # Set state to all blinds subroutine
@@ -338,9 +738,13 @@ def get_blind_state_average():
 
 # Weather data collection subroutine
 def weather_data(lat, long, api_key):
-    darksky = DarkSky(api_key)
+    # Get global variable
+    global darksky_client
+
+    if darksky_client is None:
+        darksky_client = DarkSky(api_key)
     logger.info("Powered by Dark Sky")
-    forecast = darksky.get_forecast(
+    forecast = darksky_client.get_forecast(
         lat, long,
         extend=False,
         lang=languages.ENGLISH,
@@ -353,7 +757,7 @@ def weather_data(lat, long, api_key):
 def connect_database(db_file):
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False)  # Wait for the retention job rather than failing
     except Error as e:
         logger.error(e)
     return conn
@@ -369,15 +773,39 @@ def create_event(conn, event):
 
 
 # Database connection and update subroutine
-# (Combining the two subroutines above into one)
+# (Combining the two subroutines above into one, the connection is kept open and shared between threads)
+@profiling.tracer.traced("write_event")
 def write_event(trigger_code, trigger_details, response_code, response_details, automated):
+    # Get global variable
+    global event_connection
+
     if use_database:
         logger.debug("Writing event to database")  # Write event log to database
-        conn = connect_database(DATABASE_FILE_NAME)
         event = (trigger_code, trigger_details, response_code, response_details, automated)
-        with conn:
-            create_event(conn, event)
-        conn.close()
+        with event_connection_lock:
+            if event_connection is None:
+                event_connection = connect_database(DATABASE_FILE_NAME)
+                if event_connection is None:
+                    return
+            try:
+                with event_connection:
+                    create_event(event_connection, event)
+            except Error as e:
+                logger.error(f"Could not write event: {e}")
+                event_connection.close()  # Start again with a new connection next time
+                event_connection = None
+
+
+# Request tracing, every API call is traced from when it is received to when the response is sent
+@app.before_request
+def start_request_span():
+    g.span_start = time.monotonic()
+
+
+@app.teardown_request
+def finish_request_span(exception=None):
+    if "span_start" in g:
+        profiling.tracer.finish("request", g.span_start, f"{request.method} {request.path}")
 
 
 # Test API call
@@ -398,24 +826,25 @@ def setdesiredtemp():
         abort(400)  # Send bad request error
 
     # Get global variables
-    global desired_temp, DESIRED_TEMP_INCREMENT
+    global desired_temp
+    config = CabinConfig.current
 
     # Get action from request
     action = request.json["action"]
 
     # Select action
     if action == "increase":
-        if desired_temp < DESIRED_TEMP_UPPER_BOUND:
+        if desired_temp < config["desired_temp_upper_bound"]:
             logger.debug("Increasing desired temperature")
-            desired_temp += DESIRED_TEMP_INCREMENT
+            desired_temp += config["desired_temp_increment"]
             desired_temp_change()
             write_event("APIDETM", str(desired_temp), "HEATDES", str(desired_temp), False)
         else:
             response = "Error: Temperature will exceed upper bound"
     elif action == "decrease":
-        if desired_temp > DESIRED_TEMP_LOWER_BOUND:
+        if desired_temp > config["desired_temp_lower_bound"]:
             logger.debug("Decreasing desired temperature")
-            desired_temp -= DESIRED_TEMP_INCREMENT
+            desired_temp -= config["desired_temp_increment"]
             desired_temp_change()
             write_event("APIDETM", str(desired_temp), "HEATDES", str(desired_temp), False)
         else:
@@ -424,7 +853,7 @@ def setdesiredtemp():
         if "desired_temp" not in request.json:
             abort(400)  # Send bad request error
         new_temp = request.json["desired_temp"]
-        if DESIRED_TEMP_LOWER_BOUND < new_temp < DESIRED_TEMP_UPPER_BOUND:
+        if config["desired_temp_lower_bound"] < new_temp < config["desired_temp_upper_bound"]:
             logger.debug("Setting desired temperature to value")
             desired_temp = new_temp
             desired_temp_change()
@@ -436,6 +865,7 @@ def setdesiredtemp():
     
     if response is None:
         response = "OK"
+    publish_heating()
     return jsonify({"response": response})  # Send response in JSON format
 
 
@@ -477,6 +907,7 @@ def setheatingmode():
     # Set value from request to global variable
     heating_mode = mode
 
+    publish_heating()
     return jsonify({"response": "OK"})  # Send OK response in JSON format
 
 
@@ -505,6 +936,7 @@ def setheatingstatus():
     else:
         abort(400)  # Send bad request error
 
+    publish_heating()
     return jsonify({"response": "OK"})  # Send OK response in JSON format
 
 
@@ -514,13 +946,22 @@ def setblind():
     logger.debug("Blind state change request received")
     logger.debug(f"Request body: {request.json}")
 
-    # Test for correct JSON request
-    if not request.json or ("blind" and "position" not in request.json):
+    # Test for correct JSON request (position is 10 open - 20 closed, or percent is 0 closed - 100 open)
+    if not request.json or "blind" not in request.json \
+            or ("position" not in request.json and "percent" not in request.json):
         abort(400)  # Send bad request error
 
     # Get blind and position from request
     selected_blind = request.json["blind"]
-    position = request.json["position"]
+    if "percent" in request.json:
+        percent = request.json["percent"]
+        if isinstance(percent, bool) or not isinstance(percent, (int, float)) or not 0 <= percent <= 100:
+            abort(400)  # Send bad request error
+        position = cabinblinds.percent_to_state(percent)
+    else:
+        position = request.json["position"]
+        if isinstance(position, bool) or not isinstance(position, (int, float)):
+            abort(400)  # Send bad request error
 
     # Check if position is in range and blind name exists, then set blind
     if 10 <= position <= 20:
@@ -538,27 +979,321 @@ def setblind():
     return jsonify({"response": "OK"})  # Send OK response in JSON format
 
 
+# Heating response update subroutine
+# (Run whenever something in the heating interface response changes)
+def publish_heating():
+    ResponseCacheObject.update("heating", {"response": "OK",
+                                           "current_temp": current_temperature,
+                                           "desired_temp": desired_temp,
+                                           "mode": heating_mode,
+                                           "status": HeaterObject.get_state()})
+    save_state()
+
+
+# Blinds response update subroutine
+# (Run whenever a blind position changes)
+def publish_blinds():
+    # Compile blind positions
+    blind_positions = {}
+    blind_percents = {}
+    for current_blind in blind_objects:
+        blind_positions[current_blind] = blind_objects[current_blind].state
+        blind_percents[current_blind] = round(blind_objects[current_blind].get_percent(), 1)
+
+    ResponseCacheObject.update("blinds", {"response": "OK",
+                                          "positions": blind_positions,
+                                          "percents": blind_percents})
+    save_state()
+
+
+# Save state subroutine
+# (Only writes to the file if something has actually changed. Blinds that are moving or haven't been driven or
+# restored yet are saved as None, so a restart drives them rather than trusting a position they may not be at.)
+def save_state():
+    if not state_restored:
+        return
+    blind_positions = {}
+    for current_blind in blind_objects:
+        blind_positions[current_blind] = blind_objects[current_blind].get_known_state()
+    try:
+        StateStoreObject.save({"desired_temp": desired_temp,
+                               "auto_heating": auto_heating,
+                               "heating_mode": heating_mode,
+                               "auto_preheat": auto_preheat,
+                               "auto_presence": auto_presence,
+                               "auto_blinds": auto_blinds,
+                               "heater": HeaterObject.get_state(),
+                               "devices": DevicesObject.get_state(),
+                               "blinds": blind_positions})
+    except OSError as e:
+        logger.error(f"Could not save state: {e}")
+
+
+# Restore state subroutine
+# (Settings are always restored. Heater, devices and blinds are only taken from the saved state if it is recent
+# enough to trust, otherwise they are driven to a known state like a fresh start.)
+def restore_state():
+    # Get global variables
+    global desired_temp, auto_heating, heating_mode, auto_preheat, auto_presence, auto_blinds, state_restored
+
+    state = StateStoreObject.load()
+    age = StateStoreObject.get_age()
+    trusted = state is not None and age is not None and age < CabinConfig.current["state_max_age"] * 60
+    if state is not None:
+        logger.info(f"Restoring saved state from {age / 60:.1f} minutes ago")
+        desired_temp = state.get("desired_temp", desired_temp)
+        desired_temp_change()
+        auto_heating = state.get("auto_heating", auto_heating)
+        heating_mode = state.get("heating_mode", heating_mode)
+        auto_preheat = state.get("auto_preheat", auto_preheat)
+        auto_presence = state.get("auto_presence", auto_presence)
+        auto_blinds = state.get("auto_blinds", auto_blinds)
+        if not trusted:
+            logger.info("Saved heater, devices and blind states are too old to trust")
+    else:
+        state = {}
+
+    # Heater and devices
+    if trusted and "heater" in state:
+        HeaterObject.restore_state(state["heater"])
+    else:
+        HeaterObject.switch(OFF)
+    if trusted and "devices" in state:
+        DevicesObject.restore_state(state["devices"])
+        if state["devices"]:
+            PresenceObject.restore_presence()  # Don't turn the devices off just because the program restarted
+            OccupancyObject.record(True)
+    else:
+        DevicesObject.switch(OFF)
+
+    # Blinds, any that aren't known are closed
+    saved_positions = state.get("blinds", {}) if trusted else {}
+    known_blinds = []
+    for current_blind in blind_objects:
+        position = saved_positions.get(current_blind)
+        if isinstance(position, (int, float)) and not isinstance(position, bool) and OPEN <= position <= CLOSED:
+            blind_objects[current_blind].restore_state(position)
+            known_blinds.append(current_blind)
+    state_restored = True
+    for current_blind in blind_objects:
+        if current_blind not in known_blinds:
+            logger.debug(f"Closing blind {current_blind}")
+            set_blind(current_blind, CLOSED)
+    save_state()
+
+
+# Cached response subroutine
+# (Sends the precomputed body, or 304 Not Modified if the client already has it.
+# With "?since=<version>" the request waits until there is a newer version.)
+def cached_response(name):
+    entry = ResponseCacheObject.get(name)
+    since = request.args.get("since", type=int)
+    if since is not None and entry.version == since and not request.environ.get("cabin.long_poll_done"):
+        entry = ResponseCacheObject.wait_for_change(name, since, CabinConfig.current["long_poll_timeout"])
+
+    if request.if_none_match.contains(entry.etag) or entry.version == since:
+        response = Response(status=304)
+    else:
+        response = Response(entry.body, mimetype="application/json")
+    response.set_etag(entry.etag)
+    response.headers["X-Cabin-Version"] = str(entry.version)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+# Long poll wait for the read API calls in async core mode, run on the event loop before the request is handed to
+# Flask so a waiting panel doesn't hold one of the API threads. cached_response then only has to answer.
+async def async_long_poll(environ):
+    name = LONG_POLL_PATHS.get(environ["PATH_INFO"])
+    if name is None:
+        return
+    try:
+        since = int(urllib.parse.parse_qs(environ["QUERY_STRING"])["since"][0])
+    except (KeyError, ValueError):
+        return
+    entry = ResponseCacheObject.get(name)
+    if entry is not None and entry.version == since:
+        await ResponseCacheObject.wait_for_change_async(name, since, CabinConfig.current["long_poll_timeout"])
+    environ["cabin.long_poll_done"] = True
+
+
 # Heating interface update API call
 @app.route("/cabinapi/getheating", methods=["GET"])
 def getheating():
     logger.debug("Heating interface update request received")
 
-    # Get global variables
-    global heating_mode, desired_temp
+    return cached_response("heating")
 
-    # Obtain current temperature
-    logger.debug("Getting temperature")
-    current_temperature = tempsensor.get_temperature()
 
-    # Obtain current heating state
-    heating_state = HeaterObject.get_state()
+# Config API call
+@app.route("/cabinapi/config", methods=["GET", "POST"])
+def config():
+    logger.debug("Config request received")
+
+    if request.method == "POST":
+        logger.debug(f"Request body: {request.json}")
+
+        # Test for correct JSON request
+        if not isinstance(request.json, dict):
+            abort(400)  # Send bad request error
+
+        # Validate, save and apply the changed settings
+        try:
+            CabinConfig.update(request.json)
+        except ValueError as e:
+            return jsonify({"response": f"Error: {e}"})
+
+    return jsonify({"response": "OK",
+                    "config": dict(CabinConfig.current)})
+
+
+# Profile API call
+@app.route("/cabinapi/debug/profile", methods=["GET"])
+def debugprofile():
+    # Only available when debug endpoints are turned on in the config
+    if not CabinConfig.current["debug_endpoints"]:
+        abort(404)  # Send not found error
+    seconds = request.args.get("seconds", 10, type=int)
+    if not 1 <= seconds <= profiling.MAX_PROFILE_SECONDS:
+        abort(400)  # Send bad request error
+
+    logger.debug(f"Profiling for {seconds} seconds")
+    stacks = profiling.profile(seconds)
+    if stacks is None:
+        return jsonify({"response": "Error: A profile is already running"})
+    return Response(stacks, mimetype="text/plain")
+
+
+# Slow operation traces API call
+@app.route("/cabinapi/debug/traces", methods=["GET"])
+def debugtraces():
+    # Only available when debug endpoints are turned on in the config
+    if not CabinConfig.current["debug_endpoints"]:
+        abort(404)  # Send not found error
+
+    return jsonify({"response": "OK",
+                    "threshold": profiling.tracer.threshold,
+                    "recorded": profiling.tracer.recorded,
+                    "spans": profiling.tracer.get_spans()})
+
+
+# Health API call
+# (Status of each watched component, with 503 Service Unavailable if any have stopped responding)
+@app.route("/cabinapi/health", methods=["GET"])
+def gethealth():
+    healthy = WatchdogObject.is_healthy()
+    return jsonify({"response": "OK" if healthy else "Error: Some components have stopped responding",
+                    "healthy": healthy,
+                    "checks": WatchdogObject.checks,
+                    "components": WatchdogObject.get_status()}), 200 if healthy else 503
+
+
+# Fault injection API call
+# (Only available in simulation, makes a component look like it has stopped responding to test the fail-safes)
+@app.route("/cabinapi/debug/fault", methods=["POST"])
+def debugfault():
+    if not emulation:
+        abort(404)  # Send not found error
+    logger.debug(f"Request body: {request.json}")
+
+    # Test for correct JSON request
+    if not request.json or request.json.get("component") not in WatchdogObject.components:
+        abort(400)  # Send bad request error
+    seconds = request.json.get("seconds", 60)
+    if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or not 0 < seconds <= 86400:
+        abort(400)  # Send bad request error
+
+    WatchdogObject.inject_fault(request.json["component"], seconds)
+    return jsonify({"response": "OK"})  # Send OK response in JSON format
+
+
+# Energy API call
+# (Heater and devices on time and energy for a day and a month, today and this month by default)
+@app.route("/cabinapi/energy", methods=["GET"])
+def getenergy():
+    logger.debug("Energy request received")
+
+    # Get the day and month from the request, checking they are real dates
+    now = datetime.now()
+    day = request.args.get("day", now.strftime("%Y-%m-%d"))
+    month = request.args.get("month", now.strftime("%Y-%m"))
+    try:
+        datetime.strptime(day, "%Y-%m-%d")
+        datetime.strptime(month, "%Y-%m")
+    except ValueError:
+        abort(400)  # Send bad request error
+
+    price = CabinConfig.current["energy_price"]
+    totals = EnergyObject.get_totals(day, month)
+    response = {"response": "OK", "day": day, "month": month}
+    for period in totals:
+        response[period] = {}
+        for socket, (seconds, watt_hours) in totals[period].items():
+            response[period][socket] = {"hours_on": round(seconds / 3600, 2),
+                                        "kwh": round(watt_hours / 1000, 3)}
+            if price:
+                response[period][socket]["cost"] = round(watt_hours / 1000 * price, 2)
+    return jsonify(response)
+
+
+# Main code loop statistics API call
+@app.route("/cabinapi/getloopstats", methods=["GET"])
+def getloopstats():
+    logger.debug("Main code loop statistics request received")
 
-    # Return response
     return jsonify({"response": "OK",
-                    "current_temp": current_temperature,
-                    "desired_temp": desired_temp,
-                    "mode": heating_mode,
-                    "status": heating_state})
+                    "interval": CabinConfig.current["loop_interval"],
+                    "statistics": loop_statistics,
+                    "rules": RulesObject.get_statistics(),
+                    "core": CORE_MODE,
+                    "async": CoreObject.get_statistics() if CoreObject is not None else None})
+
+
+# I2C bus metrics API call
+@app.route("/cabinapi/getbusmetrics", methods=["GET"])
+def getbusmetrics():
+    logger.debug("I2C bus metrics request received")
+
+    return jsonify({"response": "OK",
+                    "metrics": i2cbus.get_bus(logger, simulation=emulation).get_metrics()})
+
+
+# Presence interface update API call
+@app.route("/cabinapi/getpresence", methods=["GET"])
+def getpresence():
+    logger.debug("Presence interface update request received")
+
+    return jsonify({"response": "OK",
+                    "statistics": PresenceObject.get_statistics(),
+                    "occupancy": OccupancyObject.get_summary(),
+                    "preheat": auto_preheat})
+
+
+# Pre-heating change API call
+@app.route("/cabinapi/setpreheat", methods=["POST"])
+def setpreheat():
+    logger.debug("Pre-heating change request received")
+    logger.debug(f"Request body: {request.json}")
+
+    # Test for correct JSON request
+    if not request.json or "status" not in request.json:
+        abort(400)  # Send bad request error
+
+    # Get global variable
+    global auto_preheat
+
+    # Get status from request
+    status = request.json["status"]
+
+    # Check if bool and set value
+    if status is True or status is False:
+        logger.debug(f"Setting pre-heating to {status}")
+        auto_preheat = status
+        save_state()
+    else:
+        abort(400)  # Send bad request error
+
+    return jsonify({"response": "OK"})  # Send OK response in JSON format
 
 
 # Blind interface update API call
@@ -566,13 +1301,37 @@ def getheating():
 def getblinds():
     logger.debug("Blind interface update request received")
 
-    # Compile blind positions
-    blind_positions = {}
-    for current_blind in blind_objects:
-        blind_positions[current_blind] = blind_objects[current_blind].state
+    return cached_response("blinds")
 
-    return jsonify({"response": "OK",
-                    "positions": blind_positions})
+
+# Event log export API call
+@app.route("/cabinapi/export", methods=["GET"])
+def export():
+    logger.debug("Event log export request received")
+
+    # Check the database can be used
+    if not use_database:
+        return jsonify({"response": "Error: Event log database unavailable"})
+
+    # Get format, source and time range from request
+    export_format = request.args.get("format", "ndjson")
+    source = request.args.get("source", "events")
+    if export_format not in eventexport.FORMATS or source not in eventexport.SOURCES:
+        abort(400)  # Send bad request error
+    try:
+        start = eventexport.parse_time(request.args.get("start"))
+        end = eventexport.parse_time(request.args.get("end"))
+    except ValueError:
+        abort(400)  # Send bad request error
+
+    # Get the first chunk now so database errors can still be reported, then stream the rest
+    chunks = eventexport.export(DATABASE_FILE_NAME, export_format, source, start, end)
+    try:
+        first_chunk = next(chunks, "")
+    except Error as e:
+        logger.error(e)
+        return jsonify({"response": "Error: Could not read event log"})
+    return Response(itertools.chain([first_chunk], chunks), mimetype=eventexport.FORMATS[export_format])
 
 
 # Check if the Dark Sky API key file exists and get the key
@@ -619,6 +1378,20 @@ def validate_database_structure(file_name):
             use_database = False  # Stops functions using the database from running
             logger.warning("Event log database file is not properly set up; functions that use this database will not run.")
 
+
+# Add any trigger codes the database was made without
+def add_extra_triggers(file_name):
+    conn = connect_database(file_name)
+    if conn is None:
+        return
+    try:
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO Triggers VALUES (?, ?, ?, ?)", EXTRA_TRIGGERS)
+    except Error as e:
+        logger.error(f"Could not add the extra trigger codes: {e}")
+    finally:
+        conn.close()
+
 def main():
     global API_KEY
 
@@ -631,42 +1404,142 @@ def main():
     # Check if event log database structure is valid
     validate_database_structure(DATABASE_FILE_NAME)
 
-    # Start presence detection
-    logger.debug(energenie.setup(emulation))
-    MotionSensorObject.set_interrupt(presence_interrupt)
-    
-    # Set heating and devices to off
-    HeaterObject.switch(OFF)
-    DevicesObject.switch(OFF)
+    # Start event log retention job
+    if use_database:
+        add_extra_triggers(DATABASE_FILE_NAME)
+        eventretention.setup_database(DATABASE_FILE_NAME, logger)
+        energy.setup_database(DATABASE_FILE_NAME)
+        RetentionObject.start()
+    else:
+        EnergyObject.db_file = None  # Only keep this month's energy totals, in memory
 
-    # Start each blind object
-    for blind in blind_objects:
-        blind_objects[blind].start()
+    # Load occupancy model
+    load_occupancy_model()
 
-    # Close all blinds
-    logger.debug("Closing all blinds")
-    set_all_blinds(CLOSED)
+    # Set up the radio and motion sensor pins
+    logger.debug(energenie.setup(emulation))
+
+    # Start the watchdog (always its own thread, so it still runs if everything else is stuck)
+    WatchdogObject.start()
 
     # Run this unless interrupted by KeyboardInterrupt
     try:
-        # Start API thread
-        app_thread.start()
-
-        logger.info("Setup complete")
-        while True:  # Run forever
-            main_loop()
+        if CORE_MODE == "async":
+            asyncio.run(async_main())
+        else:
+            threads_main()
     except KeyboardInterrupt:  # Exit program cleanly when CTRL + C is pressed down
         logger.info("Shutting down")
+    shutdown()
+
+
+# Thread core mode
+# (Each blind, presence detection, the config watcher and the API run in their own threads)
+def threads_main():
+    # Start watching the config file for changes
+    ConfigWatcherObject.start()
+
+    # Start presence detection
+    PresenceObject.start()
+    MotionSensorObject.set_interrupt(PresenceObject.interrupt)
+
+    # Start the blind service thread (steps every blind)
+    BlindServiceObject.start()
+
+    # Restore the saved state, only driving the heater, devices and blinds if their saved state is too old or missing
+    restore_state()
 
-        # Shutdown presence detection
-        logger.debug(energenie.finish())
+    # Build the read API call responses
+    update_temperature()
+    publish_blinds()
 
-        # Shutdown each blind object
+    # Start API thread
+    app_thread.start()
+
+    logger.info("Setup complete")
+    while True:  # Run forever
+        main_loop()
+
+
+# Async core mode
+# (The blinds, presence detection, config watcher, main code loop and API are all tasks on one event loop)
+async def async_main():
+    # Get global variable
+    global CoreObject
+
+    loop = asyncio.get_running_loop()
+    CoreObject = asynccore.AsyncCore(logger)
+    try:
+        # Watch the config file for changes from the event loop
+        if ConfigWatcherObject.fileno() is not None:
+            loop.add_reader(ConfigWatcherObject.fileno(), config_file_changed)
+
+        # Start presence detection, the interrupt wakes the presence task up
+        PresenceObject.wakeup = asynccore.LoopEvent(loop)
+        CoreObject.start_task(CoreObject.service_loop(PresenceObject.process, PresenceObject.wakeup, "presence"),
+                              "presence")
+        MotionSensorObject.set_interrupt(PresenceObject.interrupt)
+
+        # Start a task for each blind object in place of its thread
         for blind in blind_objects:
-            blind_objects[blind].stop()
+            blind_objects[blind].wakeup = asynccore.LoopEvent(loop)
+            CoreObject.start_task(CoreObject.service_loop(blind_objects[blind].service, blind_objects[blind].wakeup,
+                                                          f"blind {blind}"), f"blind {blind}")
+
+        # Restore the saved state (in the control thread, as moving the blinds waits for the blind tasks)
+        await CoreObject.run(restore_state)
+
+        # Build the read API call responses
+        await CoreObject.call(update_temperature, default=False)
+        publish_blinds()
+
+        # Start API server
+        server = await CoreObject.serve_wsgi(app, BIND, PORT, long_poll=async_long_poll)
 
-        # Shutdown logging system
-        logging.shutdown()
+        logger.info("Setup complete")
+        async with server:
+            while True:  # Run forever
+                await async_main_loop()
+    finally:
+        if ConfigWatcherObject.fileno() is not None:
+            loop.remove_reader(ConfigWatcherObject.fileno())
+            ConfigWatcherObject.close()
+        await CoreObject.stop_tasks()
+        CoreObject.shutdown()
+
+
+# Shutdown subroutine
+def shutdown():
+    # Shutdown presence detection
+    WatchdogObject.stop()
+    logger.debug(energenie.finish())
+    PresenceObject.stop()
+    ConfigWatcherObject.stop()
+    RetentionObject.stop()
+    OccupancyObject.record(False)
+    save_occupancy_model()
+    EnergyObject.flush()
+    EnergyObject.disconnect()
+
+    # Shutdown each blind object, cutting power to all the servos in one bus transaction rather than one each
+    for blind in blind_objects:
+        blind_objects[blind].stop(cut_power=emulation)
+    BlindServiceObject.stop()
+    if not emulation:
+        try:
+            i2cbus.get_bus(logger).write_channels({blind.pcachannel: 0 for blind in blind_objects.values()})
+        except Exception as e:  # Whatever went wrong, the servos must still be stopped
+            logger.error(f"Could not cut power to the servos together, cutting each one: {e}")
+            for blind in blind_objects:
+                blind_objects[blind].stop()
+
+    # Close the event log database connection
+    with event_connection_lock:
+        if event_connection is not None:
+            event_connection.close()
+
+    # Shutdown logging system
+    logging.shutdown()
 
 
 if __name__ == "__main__":